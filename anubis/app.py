@@ -6,11 +6,18 @@ from aiohttp import web
 import sockjs
 
 from anubis import error
+from anubis.model import domain
+from anubis.model import problem
+from anubis.util import identitymap
 from anubis.util import options
 from anubis.util import locale
 from anubis.util import json
 from anubis.util import tools
 from anubis.service import bus
+from anubis.service import countcache
+from anubis.service import executor
+from anubis.service import scoreboard
+from anubis.service import smallcache
 
 options.define('debug', default=False, help='Enable debug mode.')
 options.define('static', default=True, help='Serve static files.')
@@ -33,15 +40,34 @@ options.define('cdn_prefix', default='/', help='CDN prefix.')
 _logger = logging.getLogger(__name__)
 
 
+def _init_caches():
+    # The handlers imported in Application shadow some of the model modules.
+    smallcache.init()
+    countcache.init()
+    scoreboard.init()
+    domain.init()
+    problem.init()
+
+
+async def _on_shutdown(app):
+    _logger.info('Executor stats: %s', executor.get_stats())
+    smallcache.uninit()
+    countcache.uninit()
+    scoreboard.uninit()
+    executor.uninit()
+
+
 class Application(web.Application):
     def __init__(self):
         super(Application, self).__init__(debug=options.options.debug)
         globals()[self.__class__.__name__] = lambda: self
         translation_path = path.join(path.dirname(__file__), 'locale')
         locale.load_translations(translation_path)
-        # TODO: Add small cache.
+        _init_caches()
+        self.on_shutdown.append(_on_shutdown)
         # TODO: Add Message Queue Register.
         loop = asyncio.get_event_loop()
+        loop.set_task_factory(identitymap.task_factory)
         loop.run_until_complete(asyncio.gather(tools.create_all_indexes(), bus.init()))
 
         from anubis.handler import domain
@@ -56,6 +82,7 @@ class Application(web.Application):
         from anubis.handler import fs
         from anubis.handler import campaign
         from anubis.handler import student
+        from anubis.handler import system
         if options.options.static:
             self.router.add_static(
                 '/', path.join(path.dirname(__file__), '.static_build'), name='static')
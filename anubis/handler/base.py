@@ -25,6 +25,7 @@ from anubis.model import opcount
 from anubis.model.adaptor import setting
 from anubis.service import mailer
 from anubis.util import cipher
+from anubis.util import identitymap
 from anubis.util import json
 from anubis.util import locale
 from anubis.util import options
@@ -48,7 +49,6 @@ class HandlerBase(setting.SettingMixin):
                 raise error.UserNotFoundError(uid)
             if not self.domain_user:
                 self.domain_user = {}
-            self.user = await user.get_by_uid(self.session['uid']) or builtin.USER_GUEST
         else:
             self.user = builtin.USER_GUEST
             self.domain = await domain.get(self.domain_id)
@@ -205,11 +205,16 @@ class HandlerBase(setting.SettingMixin):
 class Handler(web.View, HandlerBase):
 
     async def _iter(self):
+        # Documents read by model getters are shared in the request, e.g. the user of session.
+        self.identity_map = identitymap.begin()
         try:
             self.response = web.Response()
             await HandlerBase.prepare(self)
             await super(Handler, self)._iter()
         except error.UserFacingError as e:
+            if self.response.prepared:
+                self._abort(e)
+                raise
             _logger.warning('User facing error: %s', repr(e))
             self.response.set_status(e.http_status, None)
             if self.prefer_json:
@@ -220,6 +225,9 @@ class Handler(web.View, HandlerBase):
                             page_name='error', page_title=self.translate('error'),
                             path_components=self.build_path(self.translate('error'), None))
         except Exception as e:
+            if self.response.prepared:
+                self._abort(e)
+                raise
             _logger.error('Unexpected exception occurred when handling %s (IP = %s, UID = %d): %s',
                           self.url, self.remote_ip, self.user['_id'] or None, repr(e))
             if options.options.debug:
@@ -238,19 +246,45 @@ class Handler(web.View, HandlerBase):
             error_json = json.encode(error_info)
             error_message = cipher.encrypt(error_json.encode('utf8'))
             self.render('500.html', error_message=error_message)
+        finally:
+            identitymap.end()
+            _logger.debug('%s %s: %d reads, %d hits in identity map', self.request.method, self.url,
+                          self.identity_map.reads, self.identity_map.hits)
         return self.response
 
+    def _abort(self, e):
+        """Abort the connection of a response which is partly sent, so that the client does not
+        take the truncated body as complete."""
+        _logger.error('Exception occurred after the response is sent when handling %s: %s',
+                      self.url, repr(e))
+        self.request.transport.close()
+
     def render(self, template_name, **kwargs):
         self.response.content_type = 'text/html'
         self.response.text = self.render_html(template_name, **kwargs)
 
     def json(self, obj):
         self.response.content_type = 'application/json'
-        self.response.headers.add('Cache-Control', 'no-store, no-cache, must-revalidate')
+        self.response.headers.setdefault('Cache-Control', 'no-store, no-cache, must-revalidate')
         self.response.text = json.encode(obj)
 
-    async def binary(self, data, type='application/octet-stream', *, filename: str=None):
-        self.response = web.StreamResponse()
+    def check_etag(self, etag):
+        """Set the entity tag of the response.
+
+        Returns:
+            True if the client already has this version and a 304 response is set.
+        """
+        etag = '"{0}"'.format(etag)
+        self.response.headers['ETag'] = etag
+        self.response.headers['Cache-Control'] = 'private, no-cache'
+        if_none_match = self.request.headers.get('If-None-Match', '')
+        if etag in (tag.strip() for tag in if_none_match.split(',')):
+            self.response.set_status(web.HTTPNotModified.status_code, None)
+            return True
+        return False
+
+    async def binary(self, data, type='application/octet-stream', *, filename: str=None, headers=None):
+        self.response = web.StreamResponse(headers=headers)
         self.response.content_length = len(data)
         self.response.content_type = type
         if filename:
@@ -258,6 +292,16 @@ class Handler(web.View, HandlerBase):
         await self.response.prepare(self.request)
         await self.response.write(data)
 
+    async def stream(self, type='application/octet-stream', *, filename: str=None):
+        """Start a response of unknown length. Returns the response to write the chunks to."""
+        self.response = web.StreamResponse()
+        self.response.content_type = type
+        self.response.enable_chunked_encoding()
+        if filename:
+            self.response.headers['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
+        await self.response.prepare(self.request)
+        return self.response
+
     async def send_mail(self, mail, title, template_name, **kwargs):
         content = self.render_html(template_name, url_prefix=options.options.url_prefix, **kwargs)
         await mailer.send_mail(mail, '{0} - SUT Online Judge'.format(self.translate(title)), content)
@@ -18,6 +18,7 @@ from anubis.model import discussion
 from anubis.handler import base
 from anubis.util import pagination
 from anubis.util import validator
+from anubis.service import executor
 from anubis.service import gen_pdf
 
 
@@ -46,7 +47,8 @@ class CampaignMainHandler(base.Handler, CampaignStatusMixin):
     @base.sanitize
     async def get(self, *, page: int=1):
         cdocs = campaign.get_multi()
-        cdocs, cpcount, _ = await pagination.paginate(cdocs, page, self.CAMPAIGNS_PER_PAGE)
+        cdocs, cpcount, _ = await pagination.paginate(cdocs, page, self.CAMPAIGNS_PER_PAGE,
+                                                      get_count=campaign.count)
         self.render('campaign_main.html', page=page, cpcount=cpcount, cdocs=cdocs)
 
 
@@ -65,7 +67,9 @@ class CampaignDetailHandler(base.Handler, CampaignStatusMixin):
             discussion.get_multi(builtin.DOMAIN_ID_SYSTEM,
                                  parent_type='campaign',
                                  parent_id=cdoc['_id']),
-            page, self.DISCUSSIONS_PER_PAGE
+            page, self.DISCUSSIONS_PER_PAGE,
+            get_count=functools.partial(discussion.count, builtin.DOMAIN_ID_SYSTEM,
+                                        parent_type='campaign', parent_id=cdoc['_id'])
         )
         team = await campaign.get_team_by_uid(cid, self.user['_id'])
         attended = bool(team)
@@ -278,7 +282,7 @@ class CampaignTeamCardHandler(base.Handler):
     @base.sanitize
     async def get(self, *, cid: str):
         teams = await campaign.get_list_team(cid)
-        buf = gen_pdf.gen_team_pdf(list(enumerate(teams, 1)))
+        buf = await executor.run(executor.TYPE_PDF, gen_pdf.gen_team_pdf, list(enumerate(teams, 1)))
         await self.binary(buf, 'application/pdf', filename='cards_{0}.pdf'.format(cid))
 
 
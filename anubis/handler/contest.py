@@ -2,9 +2,8 @@ import asyncio
 import calendar
 import datetime
 import functools
-import io
+import hashlib
 import pytz
-import zipfile
 from bson import objectid
 
 from anubis import app
@@ -20,8 +19,11 @@ from anubis.model import discussion
 from anubis.handler import base
 from anubis.util import pagination
 from anubis.util import json
+from anubis.util import zipstream
 from anubis.util.orderedset import OrderedSet
 from anubis.service import bus
+from anubis.service import executor
+from anubis.service import scoreboard
 
 
 class ContestStatusMixin(object):
@@ -66,17 +68,20 @@ class ContestMainHandler(base.Handler, ContestStatusMixin):
     @base.require_perm(builtin.PERM_VIEW_CONTEST)
     @base.get_argument
     @base.sanitize
-    async def get(self, *, rule: str=None, page: int=1):
+    async def get(self, *, rule: str=None, page: int=1, after: str=None):
         if not rule:
-            tdocs = contest.get_multi(self.domain_id)
+            f = {}
             qs = ''
         else:
-            tdocs = contest.get_multi(self.domain_id, rule=int(rule))
+            f = {'rule': int(rule)}
             qs = 'rule={0}'.format(int(rule))
-        tdocs, tpcount, _ = await pagination.paginate(tdocs, page, self.CONTESTS_PER_PAGE)
+        tdocs, tpcount, _, next_after = await pagination.paginate_keyset(
+            functools.partial(contest.get_multi, self.domain_id, **f),
+            [('_id', -1)], page, self.CONTESTS_PER_PAGE, after,
+            get_count=functools.partial(contest.count, self.domain_id, **f))
         tsdict = await contest.get_dict_status(self.domain_id, self.user['_id'],
                                                (tdoc['_id'] for tdoc in tdocs))
-        self.render('contest_main.html', page=page, tpcount=tpcount, qs=qs,
+        self.render('contest_main.html', page=page, tpcount=tpcount, qs=qs, next_after=next_after,
                     tdocs=tdocs, tsdict=tsdict)
 
 
@@ -92,7 +97,7 @@ class ContestDetailHandler(base.OperationHandler, ContestStatusMixin):
         tdoc = await contest.get(self.domain_id, tid)
         tsdoc, pdict = await asyncio.gather(
             contest.get_status(self.domain_id, tdoc['_id'], self.user['_id']),
-            problem.get_dict(self.domain_id, tdoc['pids'])
+            problem.get_dict(self.domain_id, tdoc['pids'], projection=problem.PROJECTION_LIST)
         )
         for index, pid in enumerate(tdoc['pids']):
             pdict[pid]['letter'] = chr(ord('A') + index)
@@ -102,7 +107,8 @@ class ContestDetailHandler(base.OperationHandler, ContestStatusMixin):
             attended = tsdoc.get('attend') == 1
             for pdetail in tsdoc.get('detail', []):
                 psdict[pdetail['pid']] = pdetail
-            rdict = await record.get_dict([psdoc['rid'] for psdoc in psdict.values()], get_hidden=True)
+            rdict = await record.get_dict([psdoc['rid'] for psdoc in psdict.values()], get_hidden=True,
+                                          projection={'domain_id': 1, 'status': 1, 'progress': 1})
         else:
             attended = False
         # discussion
@@ -110,11 +116,13 @@ class ContestDetailHandler(base.OperationHandler, ContestStatusMixin):
             discussion.get_multi(self.domain_id,
                                  parent_type='contest',
                                  parent_id=tdoc['_id']),
-            page, self.DISCUSSIONS_PER_PAGE
+            page, self.DISCUSSIONS_PER_PAGE,
+            get_count=functools.partial(discussion.count, self.domain_id,
+                                        parent_type='contest', parent_id=tdoc['_id'])
         )
         uids = set(ddoc['owner_uid'] for ddoc in ddocs)
         uids.add(tdoc['owner_uid'])
-        udict = await user.get_dict(uids)
+        udict = await user.get_dict(uids, fields=user.PROJECTION_LIST)
         path_components = self.build_path(
             (self.translate('contest_main'), self.reverse_url('contest_main')),
             (tdoc['title'], None)
@@ -149,25 +157,24 @@ class ContestCodeHandler(base.OperationHandler):
     @base.sanitize
     async def get(self, *, tid: int):
         tdoc, tsdocs = await contest.get_and_list_status(self.domain_id, tid)
+        udict = await user.get_dict((tsdoc['uid'] for tsdoc in tsdocs), fields=user.PROJECTION_PUBLIC)
         rnames = {}
         for tsdoc in tsdocs:
-            udoc = await user.get_by_uid(tsdoc['uid'])
             for pdetail in tsdoc.get('detail', []):
                 rnames[pdetail['rid']] = '{}/{}_{}'.format(contest.convert_to_letter(tdoc['pids'], pdetail['pid']),
-                                                           udoc['uname'],
+                                                           udict[tsdoc['uid']]['uname'],
                                                            pdetail['rid'])
-        output_buffer = io.BytesIO()
-        zip_file = zipfile.ZipFile(output_buffer, 'w', zipfile.ZIP_DEFLATED)
-        rdocs = record.get_multi(get_hidden=True, _id={'$in': list(rnames.keys())})
+        # Only the compression is limited, by the executor, so that slow clients do not hold
+        # the slots of others.
+        response = await self.stream('application/zip',
+                                     filename='{}_{}.zip'.format(tdoc['_id'], tdoc['title']))
+        zip_stream = zipstream.ZipStream(response.write,
+                                         functools.partial(executor.run, executor.TYPE_ZIP))
+        rdocs = record.get_multi(get_hidden=True, _id={'$in': list(rnames.keys())},
+                                 projection=record.PROJECTION_EXPORT)
         async for rdoc in rdocs:
-            zip_file.writestr('{}.{}'.format(rnames[rdoc['_id']], rdoc['lang']), rdoc['code'])
-        for zfile in zip_file.filelist:
-            zfile.create_system = 0
-        zip_file.close()
-
-        await self.binary(output_buffer.getvalue(),
-                          'application/zip',
-                          filename='{}_{}.zip'.format(tdoc['_id'], tdoc['title']))
+            await zip_stream.writestr('{}.{}'.format(rnames[rdoc['_id']], rdoc['lang']), rdoc['code'])
+        await zip_stream.close()
 
 
 @app.route('/contest/{tid:\d{4,}}/{letter:[A-Z]}', 'contest_detail_problem')
@@ -291,14 +298,21 @@ class ContestNotificationConnection(base.Connection, ContestStatusMixin):
         tdoc = await contest.get(self.domain_id, tid)
         if self.is_done(tdoc):
             raise error.ContestNotLiveError(tid)
-        tsdoc = await contest.get_status(self.domain_id, tid, self.user['_id'])
-        bus.subscribe(self.on_notification, ['contest_notification-' + str(tid)])
+        self.tdoc = tdoc
+        self.view_hidden = self.has_perm(builtin.PERM_VIEW_CONTEST_HIDDEN_STATUS)
+        await scoreboard.get(self.domain_id, tid, self.on_delta)
 
-    async def on_notification(self, e):
-        self.send(**json.decode(e['value']))
+    async def on_delta(self, delta):
+        now = datetime.datetime.utcnow()
+        if not self.view_hidden and (not contest.RULES[self.tdoc['rule']].show_func(self.tdoc, now)
+                                     or contest.is_locked(self.tdoc, now)):
+            return
+        self.send(**delta)
 
     async def on_close(self):
-        bus.unsubscribe(self.on_notification)
+        tdoc = getattr(self, 'tdoc', None)
+        if tdoc:
+            scoreboard.unwatch(self.domain_id, tdoc['_id'], self.on_delta)
 
 
 @app.route('/contest/{tid:\d{4,}}/{letter:[A-Z]}/submit', 'contest_detail_problem_submit')
@@ -371,29 +385,56 @@ class ContestDetailProblemSubmitHandler(base.Handler, ContestStatusMixin):
 
 @app.route('/contest/{tid:\d{4,}}/status', 'contest_status')
 class ContestStatusHandler(base.Handler, ContestStatusMixin):
+    STATUS_PER_PAGE = 100
+
     @base.require_perm(builtin.PERM_VIEW_CONTEST)
     @base.require_perm(builtin.PERM_VIEW_CONTEST_STATUS)
+    @base.get_argument
     @base.route_argument
     @base.sanitize
-    async def get(self, *, tid: int):
-        tdoc, tsdocs = await contest.get_and_list_status(self.domain_id, tid)
+    async def get(self, *, tid: int, page: int=1):
+        if page <= 0:
+            raise error.ValidationError('page')
+        tdoc = await contest.get(self.domain_id, tid)
         if (not contest.RULES[tdoc['rule']].show_func(tdoc, self.now)
                 and not self.has_perm(builtin.PERM_VIEW_CONTEST_HIDDEN_STATUS)):
             raise error.ContestStatusHiddenError()
+        frozen = (contest.is_locked(tdoc, self.now)
+                  and not self.has_perm(builtin.PERM_VIEW_CONTEST_HIDDEN_STATUS))
+        if frozen:
+            board = await scoreboard.get_snapshot(tdoc)
+        else:
+            board = await scoreboard.get(self.domain_id, tid)
+        etag = [tdoc, frozen, board.version, page]
+        if not self.prefer_json:
+            etag.extend([self.user['_id'], self.view_lang, self.session.get('_id')])
+        if self.check_etag(hashlib.sha1(json.encode(etag).encode()).hexdigest()):
+            return
+        page_begin, page_end = (page - 1) * self.STATUS_PER_PAGE, page * self.STATUS_PER_PAGE
+        ranked_tsdocs = board.get_slice(page_begin, page_end)
+        tspcount = (len(board) + self.STATUS_PER_PAGE - 1) // self.STATUS_PER_PAGE
+        if self.prefer_json:
+            udict = await user.get_dict([tsdoc['uid'] for _, tsdoc in ranked_tsdocs],
+                                        fields=user.PROJECTION_PUBLIC)
+            self.json({'version': board.version, 'frozen': frozen, 'page': page, 'tspcount': tspcount,
+                       'ranked_tsdocs': [{**tsdoc, 'rank': rank} for rank, tsdoc in ranked_tsdocs],
+                       'udict': udict})
+            return
         udict, pdict = await asyncio.gather(
-            user.get_dict([tsdoc['uid'] for tsdoc in tsdocs]),
+            user.get_dict([tsdoc['uid'] for _, tsdoc in ranked_tsdocs]),
             problem.get_dict(self.domain_id, tdoc['pids'])
         )
         for index, pid in enumerate(tdoc['pids']):
             pdict[pid]['letter'] = chr(ord('A') + index)
-        ranked_tsdocs = contest.RULES[tdoc['rule']].rank_func(tsdocs)
         path_components = self.build_path(
             (self.translate('contest_main'), self.reverse_url('contest_main')),
             (tdoc['title'], self.reverse_url('contest_detail', tid=tdoc['_id'])),
             (self.translate('contest_status'), None)
         )
         self.render('contest_status.html', tdoc=tdoc, ranked_tsdocs=ranked_tsdocs, dict=dict,
-                    udict=udict, pdict=pdict, path_components=path_components)
+                    udict=udict, pdict=pdict, page=page, tspcount=tspcount, frozen=frozen,
+                    page_begin=page_begin, page_end=page_end,
+                    path_components=path_components)
 
 
 @app.route('/contest/{tid:\d{4,}}/edit', 'contest_edit')
@@ -409,6 +450,10 @@ class ContestEditHandler(base.Handler, ContestStatusMixin):
         tsdoc = await contest.get_status(self.domain_id, tid, self.user['_id'])
         attended = tsdoc and tsdoc.get('attend') == 1
         duration = (tdoc['end_at'] - tdoc['begin_at']).total_seconds() / 3600  # Seconds to hours
+        if tdoc.get('lock_at'):
+            lock_minutes = int((tdoc['end_at'] - tdoc['lock_at']).total_seconds() // 60)
+        else:
+            lock_minutes = 0
         pids = ','.join(list(map(str, tdoc['pids'])))
         dt = pytz.utc.localize(tdoc['begin_at']).astimezone(self.timezone)
         path_components = self.build_path(
@@ -416,7 +461,7 @@ class ContestEditHandler(base.Handler, ContestStatusMixin):
             (tdoc['title'], self.reverse_url('contest_detail', tid=tdoc['_id'])),
             (self.translate('contest_edit'), None))
         self.render('contest_edit.html', tdoc=tdoc, udoc=udoc,
-                    duration=duration, pids=pids, attended=attended,
+                    duration=duration, lock_minutes=lock_minutes, pids=pids, attended=attended,
                     date_text=dt.strftime('%Y-%m-%d'),
                     time_text=dt.strftime('%H:%M'),
                     page_title=tdoc['title'], path_components=path_components)
@@ -429,7 +474,7 @@ class ContestEditHandler(base.Handler, ContestStatusMixin):
     @base.sanitize
     async def post(self, *, tid: int, title: str, content: str, rule: int, private: bool=False,
                    begin_at_date: str, begin_at_time: str,
-                   duration: float, pids: str):
+                   duration: float, lock_minutes: int=0, pids: str):
         tdoc = await contest.get(self.domain_id, tid)
         if not self.own(tdoc, builtin.PERM_EDIT_CONTEST_SELF):
             self.check_perm(builtin.PERM_EDIT_CONTEST)
@@ -441,6 +486,9 @@ class ContestEditHandler(base.Handler, ContestStatusMixin):
             raise error.ValidationError('begin_at_date', 'begin_at_time')
         if begin_at >= end_at:
             raise error.ValidationError('duration')
+        if lock_minutes < 0:
+            raise error.ValidationError('lock_minutes')
+        lock_at = end_at - datetime.timedelta(minutes=lock_minutes) if lock_minutes else None
         pids = list(OrderedSet(map(int, pids.split(','))))
         pdocs = await problem.get_multi(domain_id=self.domain_id, _id={'$in': pids},
                                         projection={'_id': 1}).sort('_id', 1).to_list(None)
@@ -451,7 +499,7 @@ class ContestEditHandler(base.Handler, ContestStatusMixin):
                     raise error.ProblemNotFoundError(self.domain_id, pid)
         await contest.edit(domain_id=self.domain_id, tid=tid,
                            title=title, content=content, rule=rule, private=private,
-                           begin_at=begin_at, end_at=end_at, pids=pids)
+                           begin_at=begin_at, end_at=end_at, lock_at=lock_at, pids=pids)
         for pid in pids:
             await problem.set_hidden(self.domain_id, pid, True)
         self.json_or_redirect(self.reverse_url('contest_detail', tid=tid))
@@ -481,6 +529,7 @@ class ContestCreateHandler(base.Handler, ContestStatusMixin):
                    begin_at_date: str,
                    begin_at_time: str,
                    duration: float,
+                   lock_minutes: int=0,
                    pids: str):
         try:
             begin_at = datetime.datetime.strptime(begin_at_date + ' ' + begin_at_time, '%Y-%m-%d %H:%M')
@@ -492,6 +541,9 @@ class ContestCreateHandler(base.Handler, ContestStatusMixin):
             raise error.ValidationError('begin_at_date', 'begin_at_time')
         if begin_at >= end_at:
             raise error.ValidationError('duration')
+        if lock_minutes < 0:
+            raise error.ValidationError('lock_minutes')
+        lock_at = end_at - datetime.timedelta(minutes=lock_minutes) if lock_minutes else None
         pids = list(OrderedSet(map(int, pids.split(','))))
         pdocs = await problem.get_multi(domain_id=self.domain_id, _id={'$in': pids},
                                         projection={'_id': 1}).sort('_id', 1).to_list(None)
@@ -501,7 +553,7 @@ class ContestCreateHandler(base.Handler, ContestStatusMixin):
                 if pid not in exist_pids:
                     raise error.ProblemNotFoundError(self.domain_id, pid)
         tid = await contest.add(self.domain_id, title, content, self.user['_id'],
-                                rule, private, begin_at, end_at, pids)
+                                rule, private, begin_at, end_at, pids, lock_at=lock_at)
         for pid in pids:
             await problem.set_hidden(self.domain_id, pid, True)
         self.json_or_redirect(self.reverse_url('contest_detail', tid=tid))
@@ -29,19 +29,20 @@ class DiscussionMainHandler(base.Handler):
     @base.require_perm(builtin.PERM_VIEW_DISCUSSION)
     @base.get_argument
     @base.sanitize
-    async def get(self, *, page: int=1):
-        # TODO: continuation based pagination.
-        nodes, (ddocs, dpcount, _) = await asyncio.gather(
+    async def get(self, *, page: int=1, after: str=None):
+        nodes, (ddocs, dpcount, _, next_after) = await asyncio.gather(
             discussion.get_nodes(self.domain_id),
             # TODO: exclude problem/contest discussions?
-            pagination.paginate(discussion.get_multi(self.domain_id), page, self.DISCUSSIONS_PER_PAGE)
+            pagination.paginate_keyset(functools.partial(discussion.get_multi, self.domain_id),
+                                       [('update_at', -1), ('_id', -1)], page, self.DISCUSSIONS_PER_PAGE,
+                                       after, get_count=functools.partial(discussion.count, self.domain_id))
         )
         udict, vndict = await asyncio.gather(
-            user.get_dict(ddoc['owner_uid'] for ddoc in ddocs),
+            user.get_dict((ddoc['owner_uid'] for ddoc in ddocs), fields=user.PROJECTION_LIST),
             discussion.get_dict_vnodes(self.domain_id, map(discussion.node_id, ddocs))
         )
         self.render('discussion_main_or_node.html', discussion_nodes=nodes, ddocs=ddocs,
-                    udict=udict, vndict=vndict, page=page, dpcount=dpcount,
+                    udict=udict, vndict=vndict, page=page, dpcount=dpcount, next_after=next_after,
                     datetime_stamp=self.datetime_stamp)
 
 
@@ -67,7 +68,9 @@ class DiscussionNodeHandler(base.Handler, contest.ContestStatusMixin):
             discussion.get_multi(self.domain_id,
                                  parent_type=vnode['doc_type'],
                                  parent_id=vnode['doc_id']),
-            page, self.DISCUSSIONS_PER_PAGE)
+            page, self.DISCUSSIONS_PER_PAGE,
+            get_count=functools.partial(discussion.count, self.domain_id,
+                                        parent_type=vnode['doc_type'], parent_id=vnode['doc_id']))
         uids = set(ddoc['owner_uid'] for ddoc in ddocs)
         if 'owner_uid' in vnode:
             uids.add(vnode['owner_uid'])
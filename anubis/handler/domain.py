@@ -54,7 +54,7 @@ class DomainMainHandler(base.Handler):
     async def get(self):
         (tdocs, tsdict), (ddocs, vndict), cdocs = await asyncio.gather(
             self.prepare_contest(), self.prepare_discussion(), self.prepare_campaign())
-        udict = await user.get_dict(ddoc['owner_uid'] for ddoc in ddocs)
+        udict = await user.get_dict((ddoc['owner_uid'] for ddoc in ddocs), fields=user.PROJECTION_LIST)
         nodes = await discussion.get_nodes(self.domain_id)
         utcnow = datetime.datetime.utcnow()
         self.render('domain_main.html', discussion_nodes=nodes, tdocs=tdocs, tsdict=tsdict, cdocs=cdocs,
@@ -5,6 +5,7 @@ from bson import objectid
 
 from anubis import app
 from anubis import constant
+from anubis import error
 from anubis import job
 from anubis.model import builtin
 from anubis.model import domain
@@ -17,8 +18,32 @@ from anubis.model import problem
 from anubis.model.adaptor import judge
 from anubis.service import bus
 from anubis.handler import base
+from anubis.util import options
+
+options.define('judge_max_credits', default=16, help='Maximum number of tasks prefetched by a judge.')
+options.define('judge_flush_ms', default=200,
+               help='Interval in milliseconds to flush buffered judge progress of a record.')
 
 _logger = logging.getLogger(__name__)
+_consumers = set()
+
+
+def get_consumer_stats():
+    """Get the credits and in-flight tasks of every judge connected to this worker."""
+    return [{'uid': conn.user['_id'], 'id': conn.id, 'credits': conn.credits, 'in_flight': len(conn.rids)}
+            for conn in _consumers]
+
+
+def _log_flush_error(task):
+    if not task.cancelled() and task.exception():
+        _logger.error('Failed to flush judge progress', exc_info=task.exception())
+
+
+def _parse_credits(value):
+    try:
+        return max(1, min(int(value), options.options.judge_max_credits))
+    except (TypeError, ValueError):
+        return 1
 
 
 @app.route('/judge/playground', 'judge_playground')
@@ -62,8 +87,15 @@ class JudgeNotifyConnection(base.Connection):
     @base.require_priv(builtin.PRIV_READ_RECORD_CODE | builtin.PRIV_WRITE_RECORD)
     async def on_open(self):
         self.rids = {}  # delivery_tag -> rid
+        self.updates = {}  # rid -> buffered update
+        self.flush_tasks = {}  # rid -> task of delayed flush
+        self.flushing = set()  # rids being written by flush tasks
+        # The judge announces how many tasks it can run at the same time, the broker then
+        # keeps up to that many unacknowledged tasks on this connection.
+        self.credits = _parse_credits(self.request.query.get('credits', 1))
         bus.subscribe(self.on_problem_data_change, ['problem_data_change'])
-        self.channel = await queue.consume('judge', self._on_queue_message)
+        self.channel = await queue.consume('judge', self._on_queue_message, prefetch_count=self.credits)
+        _consumers.add(self)
         asyncio.ensure_future(self.channel.close_event.wait()).add_done_callback(lambda _: self.close())
 
     async def on_problem_data_change(self, e):
@@ -71,40 +103,98 @@ class JudgeNotifyConnection(base.Connection):
         self.send(event=e['key'], **domain_id_pid)
 
     async def _on_queue_message(self, tag, *, rid):
-        # TODO(iceboy): Error handling?
+        if len(self.rids) >= self.credits:
+            # Credits are lowered after the task is prefetched, leave it to other judges.
+            await self.channel.basic_client_nack(tag, requeue=True)
+            return
         rdoc = await record.begin_judge(rid, self.user['_id'], constant.record.STATUS_FETCHED)
         if rdoc:
+            try:
+                config = await problem.get_judge_config(rdoc['domain_id'], rdoc['pid'])
+            except error.ProblemNotFoundError:
+                # Problem deleted, put the record back and eat the task.
+                await record.end_judge(rdoc['_id'], self.user['_id'], constant.record.STATUS_WAITING, 0, 0)
+                await asyncio.gather(bus.publish('record_change', rdoc['_id']),
+                                     self.channel.basic_client_ack(tag))
+                return
             self.rids[tag] = rdoc['_id']
+            # The judge fetches the test data only when it does not have data_version yet.
             self.send(rid=str(rdoc['_id']), tag=tag, pid=str(rdoc['pid']), domain_id=rdoc['domain_id'],
-                      lang=rdoc['lang'], code=rdoc['code'], type=rdoc['type'])
+                      lang=rdoc['lang'], code=rdoc['code'], type=rdoc['type'],
+                      time_ms=config['time_ms'], memory_kb=config['memory_kb'],
+                      judge_mode=config['judge_mode'], data_version=config['version'])
             await bus.publish('record_change', rdoc['_id'])
         else:
             # Record not found, eat it.
             await self.channel.basic_client_ack(tag)
 
-    async def on_message(self, *, key, tag, **kwargs):
+    def _buffer_update(self, rid, kwargs):
+        update = self.updates.setdefault(rid, {})
+        sets = update.setdefault('$set', {})
+        pushes = update.setdefault('$push', {})
+
+        def push(field, value):
+            pushes.setdefault(field, {'$each': []})['$each'].append(value)
+
+        if 'status' in kwargs:
+            sets['status'] = int(kwargs['status'])
+        if 'compiler_text' in kwargs:
+            push('compiler_texts', str(kwargs['compiler_text']))
+        if 'judge_text' in kwargs:
+            push('judge_texts', str(kwargs['judge_text']))
+        # A batch of case results can be sent in one message as 'cases'.
+        for case in ([kwargs['case']] if 'case' in kwargs else []) + list(kwargs.get('cases', [])):
+            push('cases', {
+                'status': int(case['status']),
+                'time_ms': int(case['time_ms']),
+                'memory_kb': int(case['memory_kb']),
+                'judge_text': str(case['judge_text']),
+            })
+        if 'progress' in kwargs:
+            sets['progress'] = float(kwargs['progress'])
+        for operator in ['$set', '$push']:
+            if not update[operator]:
+                del update[operator]
+        if rid not in self.flush_tasks:
+            self._schedule_flush(rid)
+
+    def _schedule_flush(self, rid):
+        task = self.flush_tasks[rid] = asyncio.ensure_future(self._flush(rid))
+        task.add_done_callback(_log_flush_error)
+
+    async def _flush(self, rid):
+        try:
+            await asyncio.sleep(options.options.judge_flush_ms / 1000)
+            self.flushing.add(rid)
+            update = self.updates.pop(rid, None)
+            if update:
+                await record.next_judge(rid, self.user['_id'], **update)
+                await bus.publish('record_change', rid)
+        finally:
+            self.flushing.discard(rid)
+            self.flush_tasks.pop(rid, None)
+            # Updates received while writing are flushed in the next interval.
+            if rid in self.updates and rid in self.rids.values():
+                self._schedule_flush(rid)
+
+    async def _cancel_flush(self, rid):
+        """Cancel the delayed flush of a record, or wait for it if it is being written."""
+        task = self.flush_tasks.pop(rid, None)
+        if task:
+            if rid not in self.flushing:
+                task.cancel()
+            await asyncio.wait([task])
+
+    async def on_message(self, *, key, tag=None, **kwargs):
         if key == 'next':
-            rid = self.rids[tag]
-            update = {}
-            if 'status' in kwargs:
-                update.setdefault('$set', {})['status'] = int(kwargs['status'])
-            if 'compiler_text' in kwargs:
-                update.setdefault('$push', {})['compiler_texts'] = str(kwargs['compiler_text'])
-            if 'judge_text' in kwargs:
-                update.setdefault('$push', {})['judge_texts'] = str(kwargs['judge_text'])
-            if 'case' in kwargs:
-                update.setdefault('$push', {})['cases'] = {
-                    'status': int(kwargs['case']['status']),
-                    'time_ms': int(kwargs['case']['time_ms']),
-                    'memory_kb': int(kwargs['case']['memory_kb']),
-                    'judge_text': str(kwargs['case']['judge_text']),
-                }
-            if 'progress' in kwargs:
-                update.setdefault('$set', {})['progress'] = float(kwargs['progress'])
-            await record.next_judge(rid, self.user['_id'], **update)
-            await bus.publish('record_change', rid)
+            self._buffer_update(self.rids[tag], kwargs)
         elif key == 'end':
             rid = self.rids.pop(tag)
+            # Buffered progress is written before the end, which is authoritative.
+            update = self.updates.pop(rid, None)
+            await self._cancel_flush(rid)
+            if update:
+                await record.next_judge(rid, self.user['_id'], **update)
             rdoc, _ = await asyncio.gather(record.end_judge(rid, self.user['_id'],
                                                             int(kwargs['status']),
                                                             int(kwargs['time_ms']),
@@ -113,12 +203,21 @@ class JudgeNotifyConnection(base.Connection):
             await judge.post_judge(rdoc)
         elif key == 'nack':
             await self.channel.basic_client_nack(tag)
+        elif key == 'credits':
+            self.credits = _parse_credits(kwargs.get('credits'))
+            await self.channel.basic_qos(prefetch_count=self.credits)
 
     async def on_close(self):
+        _consumers.discard(self)
+        bus.unsubscribe(self.on_problem_data_change)
+        self.updates.clear()
+
         async def close():
+            await asyncio.gather(*[self._cancel_flush(rid) for rid in list(self.flush_tasks)])
+
             async def reset_record(rid):
-                await record.end_judge(rid, self.user['_id'], self.id,
-                                       constant.record.STATUS_WAITING, 0, 0, 0)
+                await record.end_judge(rid, self.user['_id'],
+                                       constant.record.STATUS_WAITING, 0, 0)
                 await bus.publish('record_change', rid)
 
             await asyncio.gather(*[reset_record(rid) for rid in self.rids.values()])
@@ -48,24 +48,24 @@ class ProblemMainHandler(base.OperationHandler):
     @base.require_perm(builtin.PERM_VIEW_PROBLEM)
     @base.get_argument
     @base.sanitize
-    async def get(self, *, page: int = 1):
-        # TODO: projection
+    async def get(self, *, page: int = 1, after: str=None):
         if not self.has_perm(builtin.PERM_VIEW_PROBLEM_HIDDEN):
             f = {'hidden': False}
         else:
             f = {}
-        pdocs, ppcount, pcount = await pagination.paginate(
-            problem.get_multi(domain_id=self.domain_id, **f).sort([('_id', 1)]),
-            page, self.PROBLEMS_PER_PAGE)
+        pdocs, ppcount, pcount, next_after = await pagination.paginate_keyset(
+            functools.partial(problem.get_multi, domain_id=self.domain_id,
+                              projection=problem.PROJECTION_LIST, **f),
+            [('_id', 1)], page, self.PROBLEMS_PER_PAGE, after,
+            get_count=functools.partial(problem.count, self.domain_id, **f))
         if self.has_priv(builtin.PRIV_USER_PROFILE):
-            # TODO: projection
-            psdict = await problem.get_dict_status(self.domain_id,
-                                                   self.user['_id'],
-                                                   (pdoc['_id'] for pdoc in pdocs))
+            psdict = await problem.get_dict_status_summary(self.domain_id,
+                                                           self.user['_id'],
+                                                           (pdoc['_id'] for pdoc in pdocs))
         else:
             psdict = None
         await render_or_json_problem_list(self, page=page, ppcount=ppcount, pcount=pcount,
-                                          pdocs=pdocs, category='', psdict=psdict)
+                                          pdocs=pdocs, category='', psdict=psdict, next_after=next_after)
 
     @base.require_priv(builtin.PRIV_USER_PROFILE)
     @base.require_csrf_token
@@ -113,14 +113,15 @@ class ProblemCategoryHandler(base.OperationHandler):
         else:
             f = {}
         query = ProblemCategoryHandler.build_query(category)
-        pdocs, ppcount, pcount = await pagination.paginate(problem.get_multi(domain_id=self.domain_id,
-                                                                             **query,
-                                                                             **f).sort([('_id', 1)]),
-                                                           page, self.PROBLEMS_PER_PAGE)
+        pdocs, ppcount, pcount = await pagination.paginate(
+            problem.get_multi(domain_id=self.domain_id, projection=problem.PROJECTION_LIST,
+                              **query, **f).sort([('_id', 1)]),
+            page, self.PROBLEMS_PER_PAGE,
+            get_count=functools.partial(problem.count, self.domain_id, **query, **f))
         if self.has_priv(builtin.PRIV_USER_PROFILE):
-            psdict = await problem.get_dict_status(self.domain_id,
-                                                   self.user['_id'],
-                                                   (pdoc['_id'] for pdoc in pdocs))
+            psdict = await problem.get_dict_status_summary(self.domain_id,
+                                                           self.user['_id'],
+                                                           (pdoc['_id'] for pdoc in pdocs))
         else:
             psdict = None
         page_title = category or self.translate('(All Problems)')
@@ -232,6 +233,7 @@ class ProblemPretestConnection(base.Connection):
             num_pid = self.request.match_info['pid']
         self.pid = num_pid
         bus.subscribe(self.on_record_change, ['record_change'])
+        bus.subscribe(self.on_record_rejudge, ['record_rejudge'])
 
     async def on_record_change(self, e):
         rdoc = await record.get(objectid.ObjectId(e['value']), record.PROJECTION_PUBLIC)
@@ -252,8 +254,14 @@ class ProblemPretestConnection(base.Connection):
         rdoc['url'] = self.reverse_url('record_detail', rid=rdoc['_id'])
         self.send(rdoc=rdoc)
 
+    async def on_record_rejudge(self, e):
+        # A batch of rejudged records is announced by one event.
+        await asyncio.gather(*[self.on_record_change({'key': 'record_change', 'value': rid})
+                               for rid in json.decode(e['value'])['rids']])
+
     async def on_close(self):
         bus.unsubscribe(self.on_record_change)
+        bus.unsubscribe(self.on_record_rejudge)
 
 
 @app.route('/p/{pid}/data', 'problem_data')
@@ -265,9 +273,13 @@ class ProblemDataHandler(base.Handler):
         if (not self.own(pdoc, builtin.PERM_READ_PROBLEM_DATA_SELF)
             and not self.has_perm(builtin.PERM_READ_PROBLEM_DATA)):
             self.check_priv(builtin.PERM_READ_PROBLEM_DATA)
+        # The entity tag is the data_version sent to judges along with the task.
+        config = await problem.get_judge_config(self.domain_id, pid)
+        if self.check_etag(config['version']):
+            return
         grid_out = await problem.get_data(self.domain_id, pid)
         await self.binary(json.encode(grid_out['data']).encode('utf8'), 'application/json',
-                          filename='data_{0}.json'.format(pid))
+                          filename='data_{0}.json'.format(pid), headers=self.response.headers)
 
         """
         self.response.content_type = grid_out.content_type or 'application/zip'
@@ -1,7 +1,5 @@
 import asyncio
 import datetime
-import struct
-import calendar
 import io
 import zipfile
 from bson import objectid
@@ -18,6 +16,8 @@ from anubis.model import problem
 from anubis.model import contest
 from anubis.model import testdata
 from anubis.service import bus
+from anubis.service import executor
+from anubis.util import json
 
 
 @app.route('/records', 'record_main')
@@ -40,15 +40,16 @@ class RecordMainHandler(base.Handler):
         if tid:
             query['domain_id'] = self.domain_id
             query['tid'] = int(tid)
-        # TODO: projection, pagination
+        # TODO: pagination
         rdocs = await record.get_all_multi(**query,
-                                           get_hidden=self.has_priv(builtin.PRIV_VIEW_HIDDEN_RECORD)
+                                           get_hidden=self.has_priv(builtin.PRIV_VIEW_HIDDEN_RECORD),
+                                           projection=record.PROJECTION_LIST
                                            ).sort([('_id', -1)]).limit(50).to_list(None)
         if rdocs:
-            # TODO: projection
             udict, pdict = await asyncio.gather(
-                user.get_dict(rdoc['uid'] for rdoc in rdocs),
-                problem.get_dict_multi_domain((rdoc['domain_id'], rdoc['pid']) for rdoc in rdocs)
+                user.get_dict((rdoc['uid'] for rdoc in rdocs), fields=user.PROJECTION_LIST),
+                problem.get_dict_multi_domain(((rdoc['domain_id'], rdoc['pid']) for rdoc in rdocs),
+                                              projection=problem.PROJECTION_LIST)
             )
         else:
             udict = {}
@@ -56,17 +57,13 @@ class RecordMainHandler(base.Handler):
         # statistics
         statistics = None
         if self.has_priv(builtin.PRIV_VIEW_JUDGE_STATISTICS):
-            ts = calendar.timegm(datetime.datetime.utcnow().utctimetuple())
+            now = datetime.datetime.utcnow()
             day_count, week_count, month_count, year_count, rcount = await asyncio.gather(
-                record.get_count(objectid.ObjectId(
-                    struct.pack('>i', ts - 24 * 3600) + struct.pack('b', -1) * 8)),
-                record.get_count(objectid.ObjectId(
-                    struct.pack('>i', ts - 7 * 24 * 3600) + struct.pack('b', -1) * 8)),
-                record.get_count(objectid.ObjectId(
-                    struct.pack('>i', ts - 30 * 24 * 3600) + struct.pack('b', -1) * 8)),
-                record.get_count(objectid.ObjectId(
-                    struct.pack('>i', ts - int(365.2425 * 24 * 3600)) + struct.pack('b', -1) * 8)),
-                record.get_count())
+                record.get_stat_count('submit', now - datetime.timedelta(days=1)),
+                record.get_stat_count('submit', now - datetime.timedelta(days=7)),
+                record.get_stat_count('submit', now - datetime.timedelta(days=30)),
+                record.get_stat_count('submit', now - datetime.timedelta(days=365.2425)),
+                record.get_stat_count('submit'))
             statistics = {'day': day_count, 'week': week_count, 'month': month_count,
                           'year': year_count, 'total': rcount}
         self.render('record_main.html', rdocs=rdocs, udict=udict, pdict=pdict, statistics=statistics,
@@ -79,6 +76,7 @@ class RecordMainConnection(base.Connection):
     async def on_open(self):
         await super(RecordMainConnection, self).on_open()
         bus.subscribe(self.on_record_change, ['record_change'])
+        bus.subscribe(self.on_record_rejudge, ['record_rejudge'])
 
     async def on_record_change(self, e):
         rdoc = await record.get(objectid.ObjectId(e['value']), record.PROJECTION_PUBLIC)
@@ -100,8 +98,14 @@ class RecordMainConnection(base.Connection):
             pdoc = None
         self.send(html=self.render_html('record_main_tr.html', rdoc=rdoc, udoc=udoc, pdoc=pdoc))
 
+    async def on_record_rejudge(self, e):
+        # A batch of rejudged records is announced by one event.
+        await asyncio.gather(*[self.on_record_change({'key': 'record_change', 'value': rid})
+                               for rid in json.decode(e['value'])['rids']])
+
     async def on_close(self):
         bus.unsubscribe(self.on_record_change)
+        bus.unsubscribe(self.on_record_rejudge)
 
 
 @app.route('/records/{rid}', 'record_detail')
@@ -182,10 +186,15 @@ class RecordPretestDataHandler(base.Handler):
         if not ddoc:
             raise error.RecordDataNotFoundError(rdoc['_id'])
 
+        data = await executor.run(executor.TYPE_ZIP, self.build_zip, ddoc['content'])
+        await self.binary(data, 'application/zip')
+
+    @staticmethod
+    def build_zip(content):
         output_buffer = io.BytesIO()
         zip_file = zipfile.ZipFile(output_buffer, 'a', zipfile.ZIP_DEFLATED)
-        config_content = str(len(ddoc['content'])) + '\n'
-        for i, (data_input, data_output) in enumerate(ddoc['content']):
+        config_content = str(len(content)) + '\n'
+        for i, (data_input, data_output) in enumerate(content):
             input_file = 'input{0}.txt'.format(i)
             output_file = 'output{0}.txt'.format(i)
             config_content += '{0}|{1}|1|10|262144\n'.format(input_file, output_file)
@@ -195,5 +204,4 @@ class RecordPretestDataHandler(base.Handler):
         for zfile in zip_file.filelist:
             zfile.create_system = 0
         zip_file.close()
-
-        await self.binary(output_buffer.getvalue(), 'application/zip')
+        return output_buffer.getvalue()
@@ -0,0 +1,26 @@
+from anubis import app
+from anubis import redis
+from anubis.handler import base
+from anubis.handler import judge
+from anubis.model import builtin
+from anubis.model import contest
+from anubis.model import testdata
+from anubis.service import countcache
+from anubis.service import executor
+from anubis.service import smallcache
+
+
+@app.route('/system/stats', 'system_stats')
+class SystemStatsHandler(base.Handler):
+    @base.require_priv(builtin.PRIV_VIEW_JUDGE_STATISTICS)
+    async def get(self):
+        """Get the stats of this worker."""
+        self.json({
+            'redis': {'alive': await redis.ping(), **redis.get_stats()},
+            'judges': judge.get_consumer_stats(),
+            'contest_notifications': contest.get_notification_stats(),
+            'executor': executor.get_stats(),
+            'smallcache': smallcache.get_stats(),
+            'countcache': countcache.get_stats(),
+            'testdata_cache': testdata.get_cache_stats(),
+        })
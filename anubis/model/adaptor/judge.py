@@ -21,7 +21,8 @@ async def post_judge(rdoc):
             pass
         if rdoc['tid']:
             post_coros.append(contest.update_status(rdoc['domain_id'], rdoc['tid'], rdoc['uid'],
-                                                    rdoc['_id'], rdoc['pid'], accept))
+                                                    rdoc['_id'], rdoc['pid'], accept,
+                                                    rdoc.get('rejudged', False)))
         if not rdoc.get('rejudged'):
             if await problem.update_status(rdoc['domain_id'], rdoc['pid'], rdoc['uid'],
                                            rdoc['_id'], rdoc['status']):
@@ -30,7 +31,7 @@ async def post_judge(rdoc):
                     post_coros.append(domain.inc_user(rdoc['domain_id'], rdoc['uid'], num_accept=1))
         else:
             await job.record.user_in_problem(rdoc['uid'], rdoc['domain_id'], rdoc['pid'])
-    await asyncio.gather(*post_coros)
+    await asyncio.gather(record.inc_stat('status.{0}'.format(rdoc['status'])), *post_coros)
 
 
 async def judge_answer(domain_id: str, rid: objectid.ObjectId, pdoc, answer: str):
@@ -6,12 +6,14 @@ from pymongo import ReturnDocument
 
 from anubis import error
 from anubis import db
+from anubis.service import countcache
 from anubis.util import argmethod
 from anubis.util import validator
 from anubis.util import pwhash
 from anubis.util.orderedset import OrderedSet
 from anubis.model import domain
 from anubis.model import contest
+from anubis.model import discussion
 from anubis.model import user
 from anubis.model import builtin
 
@@ -28,16 +30,18 @@ async def add(campaign_id: str, title: str, content: str, owner_uid: int,
         raise error.ValidationError('begin_at', 'end_at')
     coll = db.Collection('campaign')
     try:
-        return (await coll.insert_one({'_id': campaign_id,
-                                       'domain_id': builtin.DOMAIN_ID_SYSTEM,
-                                       'owner_uid': owner_uid,
-                                       'title': title,
-                                       'content': content,
-                                       'is_newbie': is_newbie,
-                                       'begin_at': begin_at,
-                                       'end_at': end_at})).inserted_id
+        cid = (await coll.insert_one({'_id': campaign_id,
+                                     'domain_id': builtin.DOMAIN_ID_SYSTEM,
+                                     'owner_uid': owner_uid,
+                                     'title': title,
+                                     'content': content,
+                                     'is_newbie': is_newbie,
+                                     'begin_at': begin_at,
+                                     'end_at': end_at})).inserted_id
     except errors.DuplicateKeyError:
         raise error.CampaignAlreadyExistError(campaign_id) from None
+    await countcache.invalidate('campaign', builtin.DOMAIN_ID_SYSTEM)
+    return cid
 
 
 @argmethod.wrap
@@ -54,6 +58,11 @@ def get_multi(*, projection=None, **kwargs):
     return coll.find(kwargs, projection)
 
 
+async def count(**kwargs):
+    return await countcache.get('campaign', builtin.DOMAIN_ID_SYSTEM, kwargs,
+                                lambda: get_multi(**kwargs).count())
+
+
 @argmethod.wrap
 async def get_list(projection=None, limit: int=None, **kwargs):
     coll = db.Collection('campaign')
@@ -74,9 +83,12 @@ async def edit(campaign_id: str, **kwargs):
     end_at = kwargs['end_at'] if 'end_at' in kwargs else cdoc['end_at']
     if begin_at >= end_at:
         raise error.ValidationError('begin_at', 'end_at')
-    return await coll.find_one_and_update(filter={'_id': campaign_id},
+    cdoc = await coll.find_one_and_update(filter={'_id': campaign_id},
                                           update={'$set': {**kwargs}},
                                           return_document=ReturnDocument.AFTER)
+    if 'title' in kwargs and cdoc:
+        await discussion.unset_vnode(cdoc.get('domain_id'), 'campaign', campaign_id)
+    return cdoc
 
 
 @argmethod.wrap
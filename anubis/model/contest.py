@@ -1,6 +1,8 @@
+import asyncio
 import collections
 import datetime
 import itertools
+import logging
 
 from bson import objectid
 from pymongo import errors
@@ -10,12 +12,23 @@ from anubis import error
 from anubis import db
 from anubis.constant import contest
 from anubis.util import argmethod
+from anubis.util import identitymap
 from anubis.util import validator
 from anubis.util import json
+from anubis.util import options
+from anubis.model import discussion
 from anubis.model import system
 from anubis.model import user
 from anubis.model import record
 from anubis.service import bus
+from anubis.service import countcache
+
+options.define('contest_notification_window_ms', default=500,
+               help='Window in milliseconds to coalesce contest notifications, 0 to disable.')
+
+_logger = logging.getLogger(__name__)
+_pending_status = {}  # tid -> OrderedDict of uid -> tsdoc
+_notification_stats = collections.Counter()
 
 RULE_OI = 2
 RULE_ACM = 3
@@ -28,7 +41,7 @@ RULE_TEXTS = {
     RULE_ACM: 'ACM-ICPC',
 }
 
-Rule = collections.namedtuple('Rule', ['show_func', 'stat_func', 'status_sort', 'rank_func'])
+Rule = collections.namedtuple('Rule', ['show_func', 'stat_func', 'inc_stat_func', 'status_sort', 'rank_func'])
 
 
 def _oi_stat(tdoc, journal):
@@ -56,6 +69,37 @@ def _acm_stat(tdoc, journal):
             'detail': detail}
 
 
+def _acm_inc_stat(tdoc, tsdoc, jdoc):
+    """Apply a single journal entry on the accumulated ACM stats of a contest status.
+
+    Returns the stats to set, an empty dict if the entry does not change anything,
+    or None if the entry can not be applied incrementally (out of order or judged again).
+    """
+    details = tsdoc.get('detail', [])
+    index, pdetail = next(((i, d) for i, d in enumerate(details) if d['pid'] == jdoc['pid']),
+                          (len(details), None))
+    if pdetail:
+        if jdoc['rid'] <= pdetail['rid']:
+            return None
+        if pdetail['accept']:
+            return {}
+    naccept = pdetail['naccept'] if pdetail else 0
+    if not jdoc['accept']:
+        naccept += 1
+    real = jdoc['rid'].generation_time.replace(tzinfo=None) - tdoc['begin_at']
+    penalty = datetime.timedelta(minutes=20) * naccept
+    time = (real + penalty).total_seconds()
+    new_pdetail = {**jdoc, 'naccept': naccept, 'time': time,
+                   'balloon': pdetail.get('balloon', False) if pdetail else False}
+    stats = {'detail': [*details[:index], new_pdetail, *details[index + 1:]],
+             'accept': tsdoc.get('accept', 0),
+             'time': tsdoc.get('time', 0)}
+    if jdoc['accept']:
+        stats['accept'] += 1
+        stats['time'] += time
+    return stats
+
+
 def _acm_rank(tsdocs):
     now = 1
     gold = contest.COUNT_GOLD
@@ -82,10 +126,15 @@ def _acm_rank(tsdocs):
 
 RULES = {
     RULE_ACM: Rule(lambda tdoc, now: now >= tdoc['begin_at'],
-                   _acm_stat, [('accept', -1), ('time', 1)], _acm_rank),
+                   _acm_stat, _acm_inc_stat, [('accept', -1), ('time', 1)], _acm_rank),
 }
 
 
+def is_locked(tdoc, now):
+    """Whether the scoreboard of the contest is frozen at the given time."""
+    return bool(tdoc.get('lock_at')) and tdoc['lock_at'] <= now < tdoc['end_at']
+
+
 def convert_to_pid(pids: list, pid_letter: str):
     try:
         return pids[ord(pid_letter) - ord('A')]
@@ -129,6 +178,7 @@ async def add(domain_id: str, title: str, content: str, owner_uid: int, rule: in
         **kwargs,
     }
     await coll.insert_one(doc)
+    await countcache.invalidate('contest', domain_id)
     return tid
 
 
@@ -145,6 +195,10 @@ async def edit(domain_id: str, tid: int, **kwargs):
                                           return_document=True)
     if not tdoc:
         raise error.ContestNotFoundError(domain_id, tid)
+    if 'title' in kwargs:
+        await discussion.unset_vnode(domain_id, 'contest', tid)
+    if 'rule' in kwargs:
+        await countcache.invalidate('contest', domain_id)
     return tdoc
 
 
@@ -162,6 +216,11 @@ def get_multi(domain_id: str, projection=None, **kwargs):
     return coll.find({'domain_id': domain_id, **kwargs}, projection=projection)
 
 
+async def count(domain_id: str, **kwargs):
+    return await countcache.get('contest', domain_id, kwargs,
+                                lambda: get_multi(domain_id, **kwargs).count())
+
+
 @argmethod.wrap
 async def get_list(domain_id: str, projection=None):
     return await get_multi(domain_id=domain_id,
@@ -173,15 +232,16 @@ async def attend(domain_id: str, tid: int, uid: int):
     #  TODO: check time.
     coll = db.Collection('contest.status')
     try:
-        await coll.find_one_and_update(filter={'domain_id': domain_id,
-                                               'tid': tid,
-                                               'uid': uid,
-                                               'attend': {'$eq': 0}},
-                                       update={'$set': {'attend': 1}},
-                                       upsert=True,
-                                       return_document=ReturnDocument.AFTER)
+        tsdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
+                                                       'tid': tid,
+                                                       'uid': uid,
+                                                       'attend': {'$eq': 0}},
+                                               update={'$set': {'attend': 1}},
+                                               upsert=True,
+                                               return_document=ReturnDocument.AFTER)
     except errors.DuplicateKeyError:
         raise error.ContestAlreadyAttendedError(domain_id, tid, uid) from None
+    await publish_status(tid, uid, tsdoc)
     coll = db.Collection('contest')
     return await coll.find_one_and_update(filter={'domain_id': domain_id,
                                                   '_id': tid},
@@ -200,6 +260,7 @@ async def remove_status(domain_id: str, tid: int, uid: int):
     await coll.delete_one({'domain_id': domain_id,
                            'tid': tid,
                            'uid': uid})
+    await publish_status(tid, uid, None)
     return tsdoc
 
 
@@ -215,16 +276,23 @@ def get_multi_status(*, projection=None, **kwargs):
     return coll.find(kwargs, projection=projection)
 
 
-async def get_dict_status(domain_id, uid, tids, *, projection=None):
+async def _load_dict_status(tids, domain_id, uid, projection):
     result = dict()
     async for tsdoc in get_multi_status(domain_id=domain_id,
                                         uid=uid,
-                                        tid={'$in': list(set(tids))},
+                                        tid={'$in': tids},
                                         projection=projection):
         result[tsdoc['tid']] = tsdoc
     return result
 
 
+_status_loader = identitymap.BatchLoader('contest.status', _load_dict_status)
+
+
+async def get_dict_status(domain_id, uid, tids, *, projection=None):
+    return await _status_loader.load_many(tids, domain_id, uid, projection)
+
+
 @argmethod.wrap
 async def get_and_list_status(domain_id: str, tid: int, projection=None):
     # TODO: projection, pagination
@@ -238,63 +306,140 @@ async def get_and_list_status(domain_id: str, tid: int, projection=None):
 
 @argmethod.wrap
 async def update_status(domain_id: str, tid: int, uid: int, rid: objectid.ObjectId,
-                        pid: int, accept: bool):
+                        pid: int, accept: bool, rejudged: bool=False):
     tdoc = await get(domain_id, tid)
     if pid not in tdoc['pids']:
         raise error.ValidationError('pid')
 
+    jdoc = {'rid': rid, 'pid': pid, 'accept': accept}
     coll = db.Collection('contest.status')
-    tsdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
-                                                   'tid': tid,
-                                                   'uid': uid},
-                                           update={
-                                               '$push': {
-                                                   'journal': {'rid': rid,
-                                                               'pid': pid,
-                                                               'accept': accept}
-                                               },
-                                               '$inc': {'rev': 1}},
-                                           return_document=ReturnDocument.AFTER)
-    if not tsdoc:
-        return {}
-    if 'attend' not in tsdoc or not tsdoc['attend']:
-        raise error.ContestNotAttendedError(domain_id, tid, uid)
-
-    # Sort and uniquify journal of the contest status, by rid.
-
-    key_func = lambda j: j['rid']
-    journal = [list(g)[-1]
-               for _, g in itertools.groupby(sorted(tsdoc['journal'], key=key_func), key=key_func)]
-    stats = RULES[tdoc['rule']].stat_func(tdoc, journal)
-    psdict = {}
-    for detail in tsdoc.get('detail', []):
-        psdict[detail['pid']] = detail
-    for detail in stats.get('detail', []):
-        detail['balloon'] = psdict.get(detail['pid'], {'balloon': False}).get('balloon', False)
-    tsdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
-                                                   'tid': tid,
-                                                   'uid': uid},
-                                           update={'$set': {'journal': journal, **stats},
-                                                   '$inc': {'rev': 1}},
-                                           return_document=ReturnDocument.AFTER)
-    await bus.publish('contest_notification-' + str(tid), json.encode({'type': 'rank_changed'}))
+    while True:
+        tsdoc = await get_status(domain_id, tid, uid, projection={'journal': 0})
+        if not tsdoc:
+            return {}
+        if 'attend' not in tsdoc or not tsdoc['attend']:
+            raise error.ContestNotAttendedError(domain_id, tid, uid)
+        psdict = {}
+        for detail in tsdoc.get('detail', []):
+            psdict[detail['pid']] = detail
+        stats = None if rejudged else RULES[tdoc['rule']].inc_stat_func(tdoc, tsdoc, jdoc)
+        if stats is None:
+            tsdoc = await recalc_status(domain_id, tid, uid, jdoc, tdoc=tdoc)
+            break
+        update = {'$push': {'journal': jdoc}, '$inc': {'rev': 1}}
+        if stats:
+            update['$set'] = stats
+        tsdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
+                                                       'tid': tid,
+                                                       'uid': uid,
+                                                       'rev': tsdoc.get('rev')},
+                                               update=update,
+                                               return_document=ReturnDocument.AFTER)
+        if tsdoc:
+            break
+        # Status has been changed concurrently, retry on the latest revision.
+    if tdoc.get('lock_at') and rid < objectid.ObjectId.from_datetime(tdoc['lock_at']):
+        await _patch_snapshot(tdoc, [tsdoc])
+    await publish_status(tid, uid, tsdoc)
     if accept and not psdict.get(pid, {'accept': False})['accept']:
         await set_status_balloon(domain_id, tid, uid, pid, False)
     return tsdoc
 
 
+async def recalc_status(domain_id: str, tid: int, uid: int, jdoc=None, *, tdoc=None):
+    """Recalculate the stats of a contest status from its whole journal, appending jdoc if given.
+
+    The journal and the stats are written in one update conditioned on the revision read, and
+    recalculated on the latest revision if the status has been changed concurrently.
+    """
+    if not tdoc:
+        tdoc = await get(domain_id, tid)
+    coll = db.Collection('contest.status')
+    key_func = lambda j: j['rid']
+    while True:
+        tsdoc = await get_status(domain_id, tid, uid)
+        if not tsdoc:
+            return {}
+        journal = tsdoc.get('journal', [])
+        if jdoc:
+            journal = journal + [jdoc]
+        # Sort and uniquify journal of the contest status, by rid.
+        journal = [list(g)[-1]
+                   for _, g in itertools.groupby(sorted(journal, key=key_func), key=key_func)]
+        stats = RULES[tdoc['rule']].stat_func(tdoc, journal)
+        psdict = {}
+        for detail in tsdoc.get('detail', []):
+            psdict[detail['pid']] = detail
+        for detail in stats.get('detail', []):
+            detail['balloon'] = psdict.get(detail['pid'], {'balloon': False}).get('balloon', False)
+        tsdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
+                                                       'tid': tid,
+                                                       'uid': uid,
+                                                       'rev': tsdoc.get('rev')},
+                                               update={'$set': {'journal': journal, **stats},
+                                                       '$inc': {'rev': 1}},
+                                               return_document=ReturnDocument.AFTER)
+        if tsdoc:
+            return tsdoc
+
+
+async def publish_status(tid: int, uid: int, tsdoc):
+    """Publish the changed status of a user, or None if the status is removed.
+
+    Changes of a contest within the notification window are published as one event,
+    with the latest status of each affected user.
+    """
+    identitymap.discard('contest.status')
+    if tsdoc:
+        tsdoc = dict((k, v) for k, v in tsdoc.items() if k != 'journal')
+    _notification_stats['received'] += 1
+    if tid in _pending_status:
+        _notification_stats['suppressed'] += 1
+        _pending_status[tid].pop(uid, None)
+        _pending_status[tid][uid] = tsdoc
+        return
+    _pending_status[tid] = collections.OrderedDict([(uid, tsdoc)])
+    if options.options.contest_notification_window_ms <= 0:
+        await _flush_status(tid)
+    else:
+        asyncio.get_event_loop().create_task(_flush_status(tid, options.options.contest_notification_window_ms))
+
+
+async def _flush_status(tid, delay_ms=0):
+    if delay_ms:
+        await asyncio.sleep(delay_ms / 1000)
+    pending = _pending_status.pop(tid)
+    _notification_stats['published'] += 1
+    try:
+        await bus.publish('contest_notification-' + str(tid), json.encode({'type': 'rank_changed',
+                                                                           'uids': list(pending.keys()),
+                                                                           'tsdocs': list(pending.values())}))
+    except Exception as e:
+        _logger.exception(e)
+        if delay_ms:
+            return
+        raise
+
+
+def get_notification_stats():
+    """Get the counters of received, published and suppressed contest notifications."""
+    return dict(_notification_stats)
+
+
 @argmethod.wrap
 async def set_status_balloon(domain_id: str, tid: int, uid: int, pid: int, balloon: bool=True):
     tdoc = await get(domain_id, tid)
     if pid not in tdoc['pids']:
         raise error.ValidationError('pid')
 
+    identitymap.discard('contest.status')
     coll = db.Collection('contest.status')
     tsdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
                                                    'tid': tid,
                                                    'uid': uid,
                                                    'detail.pid': pid},
-                                           update={'$set': {'detail.$.balloon': balloon}},
+                                           update={'$set': {'detail.$.balloon': balloon},
+                                                   '$inc': {'rev': 1}},
                                            return_document=ReturnDocument.AFTER)
     udoc = await user.get_by_uid(uid)
     await bus.publish('balloon_change', json.encode({'uid': uid,
@@ -307,6 +452,75 @@ async def set_status_balloon(domain_id: str, tid: int, uid: int, pid: int, ballo
     return tsdoc
 
 
+def _snapshot_entry(tdoc, tsdoc):
+    """Get the status of a user in the snapshot, counting the journal entries before lock_at."""
+    key_func = lambda j: j['rid']
+    lock_rid = objectid.ObjectId.from_datetime(tdoc['lock_at'])
+    journal = [list(g)[-1]
+               for rid, g in itertools.groupby(sorted(tsdoc.get('journal', []), key=key_func),
+                                               key=key_func)
+               if rid < lock_rid]
+    return {'uid': tsdoc['uid'],
+            'attend': tsdoc.get('attend', 0),
+            'rev': tsdoc.get('rev', 0),
+            **RULES[tdoc['rule']].stat_func(tdoc, journal)}
+
+
+async def _patch_snapshot(tdoc, tsdocs):
+    """Replace the entries of users in the snapshot by newer revisions of their status.
+
+    Records submitted before lock_at may be judged after the snapshot is taken.
+    """
+    coll = db.Collection('contest.snapshot')
+    query = {'domain_id': tdoc['domain_id'], 'tid': tdoc['_id'], 'lock_at': tdoc['lock_at']}
+    patched = False
+    for tsdoc in tsdocs:
+        result = await coll.update_one({**query,
+                                        'tsdocs': {'$elemMatch': {'uid': tsdoc['uid'],
+                                                                  'rev': {'$lt': tsdoc.get('rev', 0)}}}},
+                                       {'$set': {'tsdocs.$': _snapshot_entry(tdoc, tsdoc)}})
+        patched = patched or result.modified_count > 0
+    if patched:
+        await bus.publish('contest_snapshot_change', {'domain_id': tdoc['domain_id'], 'tid': tdoc['_id']})
+
+
+async def get_snapshot(tdoc):
+    """Get the scoreboard snapshot taken at the lock time of the contest, creating it if necessary.
+
+    The snapshot only counts journal entries submitted before lock_at. Statuses changed while
+    it is taken are patched right after, later changes by update_status.
+    """
+    coll = db.Collection('contest.snapshot')
+    query = {'domain_id': tdoc['domain_id'], 'tid': tdoc['_id'], 'lock_at': tdoc['lock_at']}
+    snapshot = await coll.find_one(query)
+    if snapshot:
+        return snapshot
+    tsdocs = []
+    async for tsdoc in get_multi_status(domain_id=tdoc['domain_id'], tid=tdoc['_id']):
+        tsdocs.append(_snapshot_entry(tdoc, tsdoc))
+    try:
+        snapshot = await coll.find_one_and_update(filter=query,
+                                                  update={'$setOnInsert': {
+                                                      'tsdocs': tsdocs,
+                                                      'create_at': datetime.datetime.utcnow()}},
+                                                  upsert=True,
+                                                  return_document=ReturnDocument.AFTER)
+    except errors.DuplicateKeyError:
+        # Taken by another worker at the same time.
+        return await coll.find_one(query)
+    revs = dict((tsdoc['uid'], tsdoc['rev']) for tsdoc in snapshot['tsdocs'])
+    changed_uids = [tsdoc['uid']
+                    async for tsdoc in get_multi_status(domain_id=tdoc['domain_id'], tid=tdoc['_id'],
+                                                        projection={'uid': 1, 'rev': 1})
+                    if tsdoc.get('rev', 0) > revs.get(tsdoc['uid'], 0)]
+    if changed_uids:
+        tsdocs = await get_multi_status(domain_id=tdoc['domain_id'], tid=tdoc['_id'],
+                                        uid={'$in': changed_uids}).to_list(None)
+        await _patch_snapshot(tdoc, tsdocs)
+        snapshot = await coll.find_one(query)
+    return snapshot
+
+
 @argmethod.wrap
 async def create_indexes():
     coll = db.Collection('contest')
@@ -333,6 +547,10 @@ async def create_indexes():
                                     ('tid', 1),
                                     ('uid', 1),
                                     ('detail.pid', 1)], sparse=True)
+    snapshot_coll = db.Collection('contest.snapshot')
+    await snapshot_coll.create_index([('domain_id', 1),
+                                      ('tid', 1),
+                                      ('lock_at', 1)], unique=True)
 
 
 if __name__ == '__main__':
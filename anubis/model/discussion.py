@@ -9,6 +9,7 @@ from pymongo import ReturnDocument
 
 from anubis import error
 from anubis import db
+from anubis.service import countcache
 from anubis.service import smallcache
 from anubis.util import argmethod
 from anubis.util import validator
@@ -43,14 +44,37 @@ async def get_node(domain_id: str, node_name: str):
 
 @argmethod.wrap
 async def get_nodes(domain_id: str):
-    coll = db.Collection('discussion.node')
-    category_list = await coll.aggregate([
-        {'$match': {'domain_id': domain_id}},
-        {'$group': {'_id': '$category_name', 'nodes': {'$push': '$$ROOT'}}}
-    ]).to_list(None)
+    """Get the node tree of a domain, which is cached and read-only."""
+    key = smallcache.PREFIX_DISCUSSION_NODES + domain_id
+    nodes = smallcache.get(key)
+    if nodes is None:
+        coll = db.Collection('discussion.node')
+        category_list = await coll.aggregate([
+            {'$match': {'domain_id': domain_id}},
+            {'$group': {'_id': '$category_name', 'nodes': {'$push': '$$ROOT'}}}
+        ]).to_list(None)
+        nodes = collections.OrderedDict([
+            (category['_id'], category['nodes']) for category in category_list])
+        smallcache.set_local(key, nodes)
+        nodes = smallcache.get(key, nodes)
+    return nodes
+
+
+def _find_node(nodes, node_name):
+    for category_nodes in nodes.values():
+        for node in category_nodes:
+            if node['name'] == node_name:
+                return node
+    return None
+
+
+def _vnode_key(domain_id, doc_type, doc_id):
+    return '{0}{1}-{2}-{3}'.format(smallcache.PREFIX_DISCUSSION_VNODE, domain_id, doc_type, doc_id)
 
-    return collections.OrderedDict([
-        (category['_id'], category['nodes']) for category in category_list])
+
+async def unset_vnode(domain_id, doc_type, doc_id):
+    """Drop the cached vnode of a document in all workers, e.g. when it is renamed."""
+    await smallcache.unset_global(_vnode_key(domain_id, doc_type, doc_id))
 
 
 @argmethod.wrap
@@ -63,6 +87,7 @@ async def add_node(domain_id: str, category_name: str, node_name: str, node_pic:
                            'name': node_name,
                            'pic': node_pic,
                            'category_name': category_name})
+    await smallcache.unset_global(smallcache.PREFIX_DISCUSSION_NODES + domain_id)
 
 
 async def check_node(domain_id, node_name):
@@ -72,7 +97,7 @@ async def check_node(domain_id, node_name):
 
 async def get_nodes_and_vnode(domain_id, node_or_dtuple):
     nodes = await get_nodes(domain_id)
-    node = await get_node(domain_id, node_or_dtuple)
+    node = _find_node(nodes, node_or_dtuple)
     if node:
         vnode = {'doc_type': 'discussion_node',
                  'doc_id': node['name'],
@@ -116,6 +141,7 @@ async def add(domain_id: str, node_or_dtuple: str, owner_uid: int, title: str, c
            **kwargs}
     coll = db.Collection('discussion')
     res = await coll.insert_one(doc)
+    await countcache.invalidate('discussion', domain_id)
     return res.inserted_id
 
 
@@ -143,6 +169,7 @@ async def delete(domain_id: str, did: objectid.ObjectId):
     coll_reply = db.Collection('discussion.reply')
     await coll_reply.delete_many({'domain_id': domain_id,
                                   'parent_id': did})
+    await countcache.invalidate('discussion', domain_id)
 
 
 @argmethod.wrap
@@ -160,7 +187,8 @@ async def inc_views(domain_id: str, did: objectid.ObjectId):
 @argmethod.wrap
 async def count(domain_id: str, **kwargs):
     coll = db.Collection('discussion')
-    return await coll.find({'domain_id': domain_id, **kwargs}).count()
+    return await countcache.get('discussion', domain_id, kwargs,
+                                lambda: coll.find({'domain_id': domain_id, **kwargs}).count())
 
 
 @argmethod.wrap
@@ -296,19 +324,35 @@ async def delete_tail_reply(domain_id: str, drid: objectid.ObjectId, drrid: obje
 
 
 async def get_dict_vnodes(domain_id, node_or_dtuples):
+    """Get the vnodes of nodes and documents, which are cached and read-only.
+
+    Documents not in the cache are read by one query for each document type.
+    """
+    nodes = await get_nodes(domain_id)
     result = dict()
-    dtuples = set()
-    for node_or_dtuple in node_or_dtuples:
-        if await get_node(domain_id, node_or_dtuple):
+    doc_ids = collections.defaultdict(set)  # doc_type -> doc_ids
+    for node_or_dtuple in set(node_or_dtuples):
+        if _find_node(nodes, node_or_dtuple):
             result[node_or_dtuple] = {'doc_id': node_or_dtuple,
                                       'doc_type': 'discussion_node',
                                       'title': node_or_dtuple}
         elif node_or_dtuple[0] in ALLOWED_DOC_TYPES:
-            dtuples.add(node_or_dtuple)
-    for doc_type, doc_id in dtuples:
+            vnode = smallcache.get(_vnode_key(domain_id, *node_or_dtuple))
+            if vnode is not None:
+                result[node_or_dtuple] = vnode
+            else:
+                doc_ids[node_or_dtuple[0]].add(node_or_dtuple[1])
+
+    async def get_docs(doc_type):
         coll = db.Collection(doc_type)
-        doc = await coll.find_one({'domain_id': domain_id, '_id': doc_id})
-        result[(doc_type, doc_id)] = doc
+        async for doc in coll.find({'domain_id': domain_id, '_id': {'$in': list(doc_ids[doc_type])}},
+                                   projection={'title': 1}):
+            key = _vnode_key(domain_id, doc_type, doc['_id'])
+            vnode = {'doc_id': doc['_id'], 'doc_type': doc_type, 'title': doc['title']}
+            smallcache.set_local(key, vnode)
+            result[(doc_type, doc['_id'])] = smallcache.get(key, vnode)
+
+    await asyncio.gather(*[get_docs(doc_type) for doc_type in doc_ids])
     return result
 
 
@@ -1,13 +1,41 @@
+import copy
+import time
+
 from pymongo import errors
 
 from anubis import db
 from anubis import error
 from anubis.model import builtin
+from anubis.service import bus
 from anubis.util import argmethod
+from anubis.util import identitymap
+from anubis.util import options
 from anubis.util import validator
 
+options.define('domain_cache_ttl_seconds', default=300,
+               help='Time in seconds a domain document is cached in each worker.')
+
 PROJECTION_PUBLIC = {'uid': 1}
 
+_cache = {}  # domain_id -> (expire_at, ddoc), callers get copies of ddoc
+_generation = 0  # Incremented on every invalidation, so that reads in flight are not cached.
+
+
+async def _on_domain_change(e):
+    global _generation
+    _generation += 1
+    _cache.pop(e['value'], None)
+
+
+def init():
+    bus.subscribe(_on_domain_change, ['domain_change'])
+
+
+async def _invalidate(domain_id):
+    """Drop the cached document of a domain in all workers."""
+    await _on_domain_change({'value': domain_id})
+    await bus.publish('domain_change', domain_id)
+
 
 @argmethod.wrap
 async def add(domain_id: str, owner_uid: int,
@@ -36,8 +64,21 @@ async def get(domain_id: str, fields=None):
     for domain in builtin.DOMAINS:
         if domain['_id'] == domain_id:
             return domain
+    if fields is not None:
+        coll = db.Collection('domain')
+        return await identitymap.get('domain', (domain_id, repr(fields)),
+                                     lambda: coll.find_one(domain_id, fields))
+    entry = _cache.get(domain_id)
+    if entry and entry[0] > time.monotonic():
+        return copy.deepcopy(entry[1])
+    generation = _generation
     coll = db.Collection('domain')
-    return await coll.find_one(domain_id, fields)
+    ddoc = await identitymap.get('domain', (domain_id, repr(fields)),
+                                 lambda: coll.find_one(domain_id, fields))
+    if ddoc and generation == _generation:
+        _cache[domain_id] = (time.monotonic() + options.options.domain_cache_ttl_seconds,
+                             copy.deepcopy(ddoc))
+    return ddoc
 
 
 def get_multi(*, fields=None, **kwargs):
@@ -50,23 +91,29 @@ async def edit(domain_id: str, **kwargs):
     for domain in builtin.DOMAINS:
         if domain['_id'] == domain_id:
             return None
+    identitymap.discard('domain')
     coll = db.Collection('domain')
     if 'owner_uid' in kwargs:
         del kwargs['owner_uid']
     if 'name' in kwargs:
         validator.check_name(kwargs['name'])
     # TODO: check kwargs.
-    return await coll.find_one_and_update(filter={'_id': domain_id},
+    ddoc = await coll.find_one_and_update(filter={'_id': domain_id},
                                           update={'$set': {**kwargs}},
                                           return_document=True)
+    await _invalidate(domain_id)
+    return ddoc
 
 
 async def unset(domain_id, fields):
     # TODO: check fields.
+    identitymap.discard('domain')
     coll = db.Collection('domain')
-    return await coll.find_one_and_update(filter={'_id': domain_id},
+    ddoc = await coll.find_one_and_update(filter={'_id': domain_id},
                                           update={'$unset': dict((f, '') for f in set(fields))},
                                           return_document=True)
+    await _invalidate(domain_id)
+    return ddoc
 
 
 @argmethod.wrap
@@ -75,10 +122,13 @@ async def set_role(domain_id: str, role: str, perm: int):
     for domain in builtin.DOMAINS:
         if domain['_id'] == domain_id:
             return domain
+    identitymap.discard('domain')
     coll = db.Collection('domain')
-    return await coll.find_one_and_update(filter={'_id': domain_id},
+    ddoc = await coll.find_one_and_update(filter={'_id': domain_id},
                                           update={'$set': {'roles.{0}'.format(role): perm}},
                                           return_document=True)
+    await _invalidate(domain_id)
+    return ddoc
 
 
 @argmethod.wrap
@@ -93,14 +143,18 @@ async def delete_roles(domain_id: str, roles):
     for domain in builtin.DOMAINS:
         if domain['_id'] == domain_id:
             raise error.BuiltinDomainError(domain_id)
+    identitymap.discard('domain.user')
     user_coll = db.Collection('domain.user')
     await user_coll.update_many({'domain_id': domain_id, 'role': {'$in': list(roles)}},
                                 {'$unset': {'role': ''}})
+    identitymap.discard('domain')
     coll = db.Collection('domain')
-    return await coll.find_one_and_update(filter={'_id': domain_id},
+    ddoc = await coll.find_one_and_update(filter={'_id': domain_id},
                                           update={'$unset': dict(('roles.{0}'.format(role), '')
                                                                  for role in roles)},
                                           return_document=True)
+    await _invalidate(domain_id)
+    return ddoc
 
 
 @argmethod.wrap
@@ -108,19 +162,24 @@ async def transfer(domain_id: str, old_owner_uid: int, new_owner_uid: int):
     for domain in builtin.DOMAINS:
         if domain['_id'] == domain_id:
             return None
+    identitymap.discard('domain')
     coll = db.Collection('domain')
-    return await coll.find_one_and_update(filter={'_id': domain_id, 'owner_uid': old_owner_uid},
+    ddoc = await coll.find_one_and_update(filter={'_id': domain_id, 'owner_uid': old_owner_uid},
                                           update={'$set': {'owner_uid': new_owner_uid}},
                                           return_document=True)
+    await _invalidate(domain_id)
+    return ddoc
 
 
 @argmethod.wrap
 async def get_user(domain_id: str, uid: int, fields=None):
     coll = db.Collection('domain.user')
-    return await coll.find_one({'domain_id': domain_id, 'uid': uid}, fields)
+    return await identitymap.get('domain.user', (domain_id, uid, repr(fields)),
+                                 lambda: coll.find_one({'domain_id': domain_id, 'uid': uid}, fields))
 
 
 async def set_user(domain_id, uid, **kwargs):
+    identitymap.discard('domain.user')
     coll = db.Collection('domain.user')
     return await coll.find_one_and_update(filter={'domain_id': domain_id, 'uid': uid},
                                           update={'$set': kwargs},
@@ -128,6 +187,7 @@ async def set_user(domain_id, uid, **kwargs):
 
 
 async def set_users(domain_id, uids, **kwargs):
+    identitymap.discard('domain.user')
     coll = db.Collection('domain.user')
     await coll.update_many({'domain_id': domain_id, 'uid': {'$in': list(set(uids))}},
                            {'$set': kwargs},
@@ -135,6 +195,7 @@ async def set_users(domain_id, uids, **kwargs):
 
 
 async def unset_user(domain_id, uid, fields):
+    identitymap.discard('domain.user')
     coll = db.Collection('domain.user')
     return await coll.find_one_and_update(filter={'domain_id': domain_id, 'uid': uid},
                                           update={'$unset': dict((f, '') for f in set(fields))},
@@ -142,6 +203,7 @@ async def unset_user(domain_id, uid, fields):
 
 
 async def unset_users(domain_id, uids, fields):
+    identitymap.discard('domain.user')
     coll = db.Collection('domain.user')
     await coll.update_many({'domain_id': domain_id, 'uid': {'$in': list(set(uids))}},
                            {'$unset': dict((f, '') for f in set(fields))},
@@ -170,6 +232,7 @@ async def unset_users_role(domain_id: str, uids):
 
 @argmethod.wrap
 async def inc_user(domain_id, uid, **kwargs):
+    identitymap.discard('domain.user')
     coll = db.Collection('domain.user')
     return await coll.find_one_and_update(filter={'domain_id': domain_id, 'uid': uid},
                                           update={'$inc': kwargs},
@@ -177,6 +240,7 @@ async def inc_user(domain_id, uid, **kwargs):
 
 
 async def inc_user_usage(domain_id: str, uid: int, usage_field: str, usage: int, quota: int):
+    identitymap.discard('domain.user')
     coll = db.Collection('domain.user')
     try:
         return await coll.find_one_and_update(filter={'domain_id': domain_id, 'uid': uid,
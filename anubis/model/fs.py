@@ -6,6 +6,7 @@ from anubis import db
 from anubis import error
 from anubis.util import pwhash
 from anubis.util import argmethod
+from anubis.util import identitymap
 
 
 async def add(content_type):
@@ -99,17 +100,22 @@ async def get_meta(file_id: objectid.ObjectId):
     return doc
 
 
-async def get_meta_dict(file_ids):
+async def _load_meta_dict(file_ids):
     result = dict()
-    if not file_ids:
-        return result
     coll = db.Collection('fs.files')
-    docs = coll.find({'_id': {'$in': list(set(file_ids))}})
+    docs = coll.find({'_id': {'$in': file_ids}})
     async for doc in docs:
         result[doc['_id']] = doc
     return result
 
 
+_meta_loader = identitymap.BatchLoader('fs.files', _load_meta_dict)
+
+
+async def get_meta_dict(file_ids):
+    return await _meta_loader.load_many(file_ids)
+
+
 @argmethod.wrap
 async def cat(file_id: objectid.ObjectId):
     """Cat a file. Note: this method will block the thread."""
@@ -126,6 +132,7 @@ async def link_by_md5(file_md5: str, except_id: objectid.ObjectId=None):
     query = {}
     if except_id:
         query['_id'] = except_id
+    identitymap.discard('fs.files')
     coll = db.Collection('fs.files')
     doc = await coll.find_one_and_update(filter={'_id': file_md5, **query},
                                          update={'$inc': {'metadata.link': 1}},
@@ -137,6 +144,7 @@ async def link_by_md5(file_md5: str, except_id: objectid.ObjectId=None):
 @argmethod.wrap
 async def unlink(file_id: objectid.ObjectId):
     """Unlink a file."""
+    identitymap.discard('fs.files')
     coll = db.Collection('fs.files')
     doc = await coll.find_one_and_update(filter={'_id': file_id},
                                          update={'$inc': {'metadata.link': -1}},
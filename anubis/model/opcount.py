@@ -1,21 +1,69 @@
+import asyncio
 import datetime
+import hashlib
+import logging
 import time
 
+import aioredis
 from pymongo import errors
 
 from anubis import db
 from anubis import error
+from anubis import redis
 from anubis.util import argmethod
+from anubis.util import options
 
+options.define('opcount_backend', default='redis', help='Backend of operation counters, redis or mongo.')
 
 PREFIX_IP = 'ip-'
 PREFIX_USER = 'user-'
 
+_logger = logging.getLogger(__name__)
 
-@argmethod.wrap
-async def inc(op: str, id: str, period_secs: int, max_operations: int):
+# Sliding window approximated by the counts of the current and the previous fixed window,
+# the previous one weighted by how much of it is still in the window.
+#   KEYS[1]: key of the current window, KEYS[2]: key of the previous window.
+#   ARGV[1]: max operations, ARGV[2]: period in seconds, ARGV[3]: weight of the previous window.
+# Returns the count of the current window after increment, or -1 if the limit is exceeded.
+_SLIDING_WINDOW_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+if current + previous * tonumber(ARGV[3]) >= tonumber(ARGV[1]) then
+  return -1
+end
+current = redis.call('INCR', KEYS[1])
+if current == 1 then
+  redis.call('EXPIRE', KEYS[1], 2 * tonumber(ARGV[2]))
+end
+return current
+"""
+_SLIDING_WINDOW_SHA = hashlib.sha1(_SLIDING_WINDOW_SCRIPT.encode()).hexdigest()
+
+
+async def _inc_redis(op, id, period_secs, max_operations, now):
+    window = int(now // period_secs)
+    weight = 1 - (now % period_secs) / period_secs
+    keys = ['opcount_{0}_{1}_{2}'.format(op, id, window), 'opcount_{0}_{1}_{2}'.format(op, id, window - 1)]
+    args = [max_operations, period_secs, repr(weight)]
+    conn = await redis.database()
+    try:
+        count = await conn.evalsha(_SLIDING_WINDOW_SHA, keys, args)
+    except aioredis.ReplyError as e:
+        if not str(e).startswith('NOSCRIPT'):
+            raise
+        count = await conn.eval(_SLIDING_WINDOW_SCRIPT, keys, args)
+    if count < 0:
+        raise error.OpCountExceededError(op, period_secs, max_operations)
+    begin_at = datetime.datetime.utcfromtimestamp(window * period_secs)
+    return {'id': id,
+            'begin_at': begin_at,
+            'expire_at': begin_at + datetime.timedelta(seconds=period_secs),
+            op: count}
+
+
+async def _inc_mongo(op, id, period_secs, max_operations, now):
     coll = db.Collection('op_count')
-    cur_time = int(time.time())
+    cur_time = int(now)
     begin_at = datetime.datetime.utcfromtimestamp(cur_time - cur_time % period_secs)
     expire_at = begin_at + datetime.timedelta(seconds=period_secs)
     try:
@@ -31,6 +79,45 @@ async def inc(op: str, id: str, period_secs: int, max_operations: int):
         raise error.OpCountExceededError(op, period_secs, max_operations)
 
 
+@argmethod.wrap
+async def inc(op: str, id: str, period_secs: int, max_operations: int):
+    """Count an operation, raises OpCountExceededError if the limit is exceeded.
+
+    With the redis backend the limit applies to a sliding window of period_secs, and the
+    mongo backend is used when Redis is not reachable. With the mongo backend the limit
+    applies to fixed windows.
+    """
+    now = time.time()
+    if options.options.opcount_backend == 'redis':
+        try:
+            return await _inc_redis(op, id, period_secs, max_operations, now)
+        except aioredis.ReplyError:
+            raise
+        except (aioredis.RedisError, OSError) as e:
+            _logger.warning('Redis unavailable for opcount, falling back to mongo: %s', repr(e))
+    return await _inc_mongo(op, id, period_secs, max_operations, now)
+
+
+@argmethod.wrap
+async def benchmark(times: int=10000, concurrency: int=100):
+    """Compare the throughput of the redis and mongo backends, in operations per second."""
+    result = {}
+    for name, func in [('redis', _inc_redis), ('mongo', _inc_mongo)]:
+        id = 'benchmark-{0}'.format(time.time())
+        remaining = times
+
+        async def worker():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                await func('benchmark', id, 3600, times + 1, time.time())
+
+        begin = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        result[name] = times / (time.perf_counter() - begin)
+    return result
+
+
 @argmethod.wrap
 async def create_indexes():
     coll = db.Collection('op_count')
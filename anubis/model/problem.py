@@ -1,4 +1,6 @@
+import asyncio
 import datetime
+import hashlib
 import itertools
 
 from bson import objectid
@@ -7,12 +9,33 @@ from pymongo import errors
 from anubis import constant
 from anubis import db
 from anubis import error
-from anubis.model import fs
+from anubis.model import discussion
 from anubis.model import system
 from anubis.model import testdata
+from anubis.service import bus
+from anubis.service import countcache
 from anubis.util import argmethod
+from anubis.util import identitymap
+from anubis.util import json
+from anubis.util import lrucache
+from anubis.util import options
 from anubis.util import validator
 
+options.define('problem_config_cache_max_bytes', default=4 * 1024 * 1024,
+               help='Maximum size in bytes of problem judge configs cached in memory.')
+
+JUDGE_CONFIG_FIELDS = ['time_ms', 'memory_kb', 'judge_mode', 'data', 'data_md5']
+
+PROJECTION_LIST = {'_id': 1, 'domain_id': 1, 'title': 1, 'hidden': 1, 'judge_mode': 1,
+                   'num_submit': 1, 'num_accept': 1, 'difficulty': 1}
+PROJECTION_JUDGE = dict((key, 1) for key in JUDGE_CONFIG_FIELDS)
+PROJECTION_ALL = None
+# Fields of problem.status shown in problem lists, kept in problem.status.summary.
+SUMMARY_FIELDS = ['status', 'rid', 'star']
+
+# (domain_id, pid) -> config
+_judge_configs = lrucache.LRUCache(options.options.problem_config_cache_max_bytes)
+
 
 @argmethod.wrap
 async def add(domain_id: str, title: str, content: str, owner_uid: int,
@@ -36,20 +59,24 @@ async def add(domain_id: str, title: str, content: str, owner_uid: int,
            'num_submit': 0,
            'num_accept': 0,
            **kwargs}
-    return await coll.insert(doc)
+    pid = await coll.insert(doc)
+    await countcache.invalidate('problem', domain_id)
+    return pid
 
 
 @argmethod.wrap
 async def get(domain_id: str, pid: int, uid: int=None):
     coll = db.Collection('problem')
-    pdoc = await coll.find_one({'domain_id': domain_id,
-                                '_id': pid})
-    if not pdoc:
-        raise error.ProblemNotFoundError(domain_id, pid)
     if uid is not None:
-        pdoc['psdoc'] = await get_status(domain_id, pid=pid, uid=uid)
+        pdoc, psdoc = await asyncio.gather(coll.find_one({'domain_id': domain_id,
+                                                         '_id': pid}),
+                                           get_status(domain_id, pid=pid, uid=uid))
     else:
-        pdoc['psdoc'] = None
+        pdoc, psdoc = await coll.find_one({'domain_id': domain_id,
+                                           '_id': pid}), None
+    if not pdoc:
+        raise error.ProblemNotFoundError(domain_id, pid)
+    pdoc['psdoc'] = psdoc
     return pdoc
 
 
@@ -59,6 +86,7 @@ async def edit(domain_id: str, pid: int, **kwargs):
         validator.check_title(kwargs['title'])
     if 'content' in kwargs:
         validator.check_content(kwargs['content'])
+    identitymap.discard('problem')
     coll = db.Collection('problem')
     pdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
                                                   '_id': pid},
@@ -66,12 +94,57 @@ async def edit(domain_id: str, pid: int, **kwargs):
                                           return_document=True)
     if not pdoc:
         raise error.ProblemNotFoundError(domain_id, pid)
+    if 'title' in kwargs:
+        await discussion.unset_vnode(domain_id, 'problem', pid)
+    if 'hidden' in kwargs or 'tag' in kwargs:
+        await countcache.invalidate('problem', domain_id)
+    if any(key in kwargs for key in JUDGE_CONFIG_FIELDS):
+        _judge_configs.unset((domain_id, pid))
+        await bus.publish('problem_data_change', {'domain_id': domain_id, 'pid': pid})
     return pdoc
 
 
+async def get_judge_config(domain_id: str, pid: int):
+    """Get the judge config of a problem through the in-memory cache.
+
+    The version is the hash of the config and the content hash of its test data, judges
+    can keep their local copy of the problem as long as the version is not changed.
+    Cached configs are dropped on problem_data_change, see forget_judge_config().
+    """
+    config = _judge_configs.get((domain_id, pid))
+    if config:
+        return config
+    coll = db.Collection('problem')
+    pdoc = await coll.find_one({'domain_id': domain_id, '_id': pid},
+                               projection=PROJECTION_JUDGE)
+    if not pdoc:
+        raise error.ProblemNotFoundError(domain_id, pid)
+    config = dict((key, pdoc.get(key)) for key in JUDGE_CONFIG_FIELDS)
+    config['version'] = hashlib.md5(json.encode(config).encode()).hexdigest()
+    _judge_configs.set((domain_id, pid), config)
+    return config
+
+
+def forget_judge_config(domain_id: str=None, pid: int=None):
+    """Drop the cached judge config of a problem, or all of them if not specified."""
+    if pid is None:
+        _judge_configs.clear()
+    else:
+        _judge_configs.unset((domain_id, pid))
+
+
+async def _on_problem_data_change(e):
+    forget_judge_config(**e['value'])
+
+
+def init():
+    bus.subscribe(_on_problem_data_change, ['problem_data_change'])
+
+
 @argmethod.wrap
 async def count(domain_id: str, **kwargs):
-    return await get_multi(domain_id=domain_id, **kwargs).count()
+    return await countcache.get('problem', domain_id, kwargs,
+                                lambda: get_multi(domain_id=domain_id, **kwargs).count())
 
 
 def get_multi(*, projection=None, **kwargs):
@@ -79,29 +152,30 @@ def get_multi(*, projection=None, **kwargs):
     return coll.find(kwargs, projection=projection)
 
 
-async def get_dict(domain_id, pids, *, projection=None):
-    result = dict()
-    async for pdoc in get_multi(domain_id=domain_id,
-                                _id={'$in': list(set(pids))},
-                                projection=projection):
-        result[pdoc['_id']] = pdoc
-    return result
-
-
-async def get_dict_multi_domain(pdom_and_ids, *, projection=None):
+async def _load_dict(pdom_and_ids, projection):
     query = {'$or': []}
     key_func = lambda e: e[0]
-    for domain_id, ptuples in itertools.groupby(sorted(set(pdom_and_ids), key=key_func),
+    for domain_id, ptuples in itertools.groupby(sorted(pdom_and_ids, key=key_func),
                                                 key=key_func):
         query['$or'].append({'domain_id': domain_id, '_id': {'$in': [e[1] for e in ptuples]}})
     result = dict()
-    if not query['$or']:
-        return result
     async for pdoc in get_multi(**query, projection=projection):
         result[(pdoc['domain_id'], pdoc['_id'])] = pdoc
     return result
 
 
+_loader = identitymap.BatchLoader('problem', _load_dict)
+
+
+async def get_dict(domain_id, pids, *, projection=None):
+    pdict = await _loader.load_many(((domain_id, pid) for pid in pids), projection)
+    return dict((pid, pdoc) for (_, pid), pdoc in pdict.items())
+
+
+async def get_dict_multi_domain(pdom_and_ids, *, projection=None):
+    return await _loader.load_many(pdom_and_ids, projection)
+
+
 @argmethod.wrap
 async def get_status(domain_id: str, pid: int, uid: int, projection=None):
     coll = db.Collection('problem.status')
@@ -147,29 +221,94 @@ async def get_dict_status(domain_id, uid, pids, *, projection=None):
     return result
 
 
+async def get_status_summary(domain_id, uid):
+    """Get the summary of problem statuses of a user in a domain.
+
+    The summary is a single document maintained alongside problem.status, so that the status of
+    a whole page of problems is read at once. It is built from problem.status on first read, and
+    built again if it is updated while being built.
+
+    Returns:
+        Dict of str(pid) -> dict of the SUMMARY_FIELDS of the problem status.
+    """
+    coll = db.Collection('problem.status.summary')
+    while True:
+        doc = await coll.find_one({'domain_id': domain_id, 'uid': uid},
+                                  projection={'problems': 1, 'rev': 1, 'built': 1})
+        if doc and doc.get('built'):
+            return doc['problems']
+        problems = {}
+        async for psdoc in get_multi_status(domain_id=domain_id, uid=uid,
+                                            projection=dict((f, 1) for f in ('pid', *SUMMARY_FIELDS))):
+            entry = dict((f, psdoc[f]) for f in SUMMARY_FIELDS if f in psdoc)
+            if entry:
+                problems[str(psdoc['pid'])] = entry
+        # Updates of the summary increment rev, they are also in problem.status read above
+        # unless rev has changed since the summary was read.
+        rev = doc['rev'] if doc and 'rev' in doc else {'$exists': False}
+        try:
+            result = await coll.update_one({'domain_id': domain_id, 'uid': uid, 'rev': rev},
+                                           {'$set': {'problems': problems, 'built': True}},
+                                           upsert=not doc)
+        except errors.DuplicateKeyError:
+            continue
+        if result.matched_count or result.upserted_id:
+            return problems
+
+
+async def _set_status_summary(domain_id, pid, uid, **kwargs):
+    """Update the summary of problem statuses, or create it to be built on its next read."""
+    kwargs = dict((k, v) for k, v in kwargs.items() if k in SUMMARY_FIELDS)
+    if not kwargs:
+        return
+    coll = db.Collection('problem.status.summary')
+    update = {'$set': dict(('problems.{0}.{1}'.format(pid, k), v) for k, v in kwargs.items()),
+              '$inc': {'rev': 1}}
+    try:
+        await coll.update_one({'domain_id': domain_id, 'uid': uid}, update, upsert=True)
+    except errors.DuplicateKeyError:
+        # Created by a concurrent update or build, the retry updates it.
+        await coll.update_one({'domain_id': domain_id, 'uid': uid}, update)
+
+
+async def get_dict_status_summary(domain_id, uid, pids):
+    """Get the problem statuses of pids from the summary, in the same form as get_dict_status."""
+    problems = await get_status_summary(domain_id, uid)
+    result = dict()
+    for pid in pids:
+        entry = problems.get(str(pid))
+        if entry:
+            result[pid] = dict(entry, domain_id=domain_id, pid=pid, uid=uid)
+    return result
+
+
 async def get_data(domain_id, pid):
     pdoc = await get(domain_id, pid)
     if not pdoc.get('data', None):
         raise error.ProblemDataNotFoundError(domain_id, pid)
-    return await testdata.get(domain_id, pdoc['data'])
+    return await testdata.get_cached(domain_id, pdoc['data'], pdoc.get('data_md5'))
 
 
 @argmethod.wrap
 async def get_data_md5(domain_id: str, pid: int):
-    pdoc = await get(domain_id, pid)
-    if not pdoc['data']:
-        raise error.ProblemDataNotFoundError(domain_id, pid)
-    return await fs.get_md5(pdoc['data'])
+    ddoc = await get_data(domain_id, pid)
+    return ddoc.get('md5') or testdata.get_md5(ddoc['data'])
 
 
 @argmethod.wrap
 async def set_star(domain_id: str, pid: int, uid: int, star: bool):
-    return await set_status(domain_id, pid, uid, star=star)
+    psdoc = await set_status(domain_id, pid, uid, star=star)
+    await _set_status_summary(domain_id, pid, uid, star=star)
+    return psdoc
 
 
 @argmethod.wrap
 async def set_data(domain_id: str, pid: int, data: objectid.ObjectId):
-    pdoc = await edit(domain_id, pid, data=data)
+    ddoc = await testdata.get(domain_id, data)
+    if not ddoc:
+        raise error.ProblemDataNotFoundError(domain_id, pid)
+    data_md5 = ddoc.get('md5') or testdata.get_md5(ddoc['data'])
+    pdoc = await edit(domain_id, pid, data=data, data_md5=data_md5)
     if not pdoc:
         raise error.ProblemNotFoundError(domain_id, pid)
     return pdoc
@@ -185,6 +324,7 @@ async def set_hidden(domain_id: str, pid: int, hidden: bool):
 
 @argmethod.wrap
 async def inc(domain_id: str, pid: int, key: str, value: int):
+    identitymap.discard('problem')
     coll = db.Collection('problem')
     return await coll.find_one_and_update(filter={'domain_id': domain_id,
                                                   '_id': pid},
@@ -204,28 +344,33 @@ async def rev_init_status(domain_id, pid, uid):
 
 async def rev_set_status(domain_id, pid, uid, rev, **kwargs):
     coll = db.Collection('problem.status')
-    return await coll.find_one_and_update(filter={'domain_id': domain_id,
-                                                  'pid': pid,
-                                                  'uid': uid,
-                                                  'rev': rev},
-                                          update={'$set': kwargs,
-                                                  '$inc': {'rev': 1}},
-                                          return_document=True)
+    psdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
+                                                   'pid': pid,
+                                                   'uid': uid,
+                                                   'rev': rev},
+                                           update={'$set': kwargs,
+                                                   '$inc': {'rev': 1}},
+                                           return_document=True)
+    if psdoc:
+        await _set_status_summary(domain_id, pid, uid, **kwargs)
+    return psdoc
 
 
 @argmethod.wrap
 async def update_status(domain_id: str, pid: int, uid: int, rid: objectid.ObjectId, status: int):
     coll = db.Collection('problem.status')
     try:
-        return await coll.find_one_and_update(filter={'domain_id': domain_id,
-                                                      'pid': pid,
-                                                      'uid': uid,
-                                                      'status': {'$ne': constant.record.STATUS_ACCEPTED}},
-                                              update={'$set': {'status': status, 'rid': rid}},
-                                              return_document=True,
-                                              upsert=True)
+        psdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
+                                                       'pid': pid,
+                                                       'uid': uid,
+                                                       'status': {'$ne': constant.record.STATUS_ACCEPTED}},
+                                               update={'$set': {'status': status, 'rid': rid}},
+                                               return_document=True,
+                                               upsert=True)
     except errors.DuplicateKeyError:
         return None
+    await _set_status_summary(domain_id, pid, uid, status=status, rid=rid)
+    return psdoc
 
 
 @argmethod.wrap
@@ -255,6 +400,9 @@ async def create_indexes():
     await status_coll.create_index([('domain_id', 1),
                                     ('uid', 1),
                                     ('pid', 1)], unique=True)
+    summary_coll = db.Collection('problem.status.summary')
+    await summary_coll.create_index([('domain_id', 1),
+                                     ('uid', 1)], unique=True)
 
 
 if __name__ == '__main__':
@@ -9,10 +9,17 @@ async def publish(key, **kwargs):
     await channel.basic_publish(bson.BSON.encode(kwargs), '', key)
 
 
-async def consume(key, on_message):
+async def publish_many(key, docs):
+    channel = await mq.channel('queue')
+    await channel.queue_declare(key)
+    for doc in docs:
+        await channel.basic_publish(bson.BSON.encode(doc), '', key)
+
+
+async def consume(key, on_message, prefetch_count=1):
     channel = await mq.channel()
     await channel.queue_declare(key)
-    await channel.basic_qos(prefetch_count=1)
+    await channel.basic_qos(prefetch_count=prefetch_count)
     await channel.basic_consume((lambda channel, body, envelope, properties:
                                  on_message(envelope.delivery_tag, **bson.BSON.decode(body))), key)
     return channel
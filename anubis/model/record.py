@@ -1,5 +1,8 @@
 import asyncio
+import collections
 import datetime
+import logging
+import time
 from bson import objectid
 
 from anubis import db
@@ -8,15 +11,36 @@ from anubis.model import problem
 from anubis.model import contest
 from anubis.model import domain
 from anubis.model import queue
+from anubis.model import system
 from anubis.service import bus
 from anubis.util import argmethod
+from anubis.util import identitymap
+from anubis.util import json
+from anubis.util import options
 from anubis.util import validator
 from anubis.model.adaptor import judge
 
+options.define('rejudge_batch_size', default=500, help='Number of records rejudged in one batch.')
+options.define('rejudge_concurrency', default=4, help='Number of batches rejudged concurrently.')
+
+_logger = logging.getLogger(__name__)
 
 PROJECTION_PUBLIC = {'code': 0}
+PROJECTION_LIST = {'_id': 1, 'domain_id': 1, 'pid': 1, 'uid': 1, 'tid': 1, 'type': 1, 'lang': 1,
+                   'status': 1, 'progress': 1, 'time_ms': 1, 'memory_kb': 1}
+PROJECTION_EXPORT = {'_id': 1, 'uid': 1, 'pid': 1, 'lang': 1, 'code': 1}
 PROJECTION_ALL = None
 
+_REJUDGE_UPDATE = {'$unset': {'judge_uid': '',
+                              'judge_at': '',
+                              'compiler_texts': '',
+                              'judge_texts': '',
+                              'cases': ''},
+                   '$set': {'status': constant.record.STATUS_WAITING,
+                            'time_ms': 0,
+                            'memory_kb': 0,
+                            'rejudged': True}}
+
 
 @argmethod.wrap
 async def add(domain_id: str, pid: int, type: int, uid: int, lang: str, code: str,
@@ -50,7 +74,7 @@ async def add(domain_id: str, pid: int, type: int, uid: int, lang: str, code: st
         post_coros.extend([problem.inc(domain_id, pid, 'num_submit', 1),
                            problem.inc_status(domain_id, pid, uid, 'num_submit', 1),
                            domain.inc_user(domain_id, uid, num_submit=1)])
-    await asyncio.gather(*post_coros)
+    await asyncio.gather(inc_stat('submit', rid.generation_time), *post_coros)
     return rid
 
 
@@ -61,6 +85,7 @@ async def get(record_id: objectid.ObjectId, projection=PROJECTION_ALL):
 
 
 async def remove_property(record_id: objectid.ObjectId, property_name: str):
+    identitymap.discard('record')
     coll = db.Collection('record')
     return await coll.find_one_and_update(filter={'_id': record_id},
                                           update={'$unset': {property_name: ''}})
@@ -68,17 +93,10 @@ async def remove_property(record_id: objectid.ObjectId, property_name: str):
 
 @argmethod.wrap
 async def rejudge(record_id: objectid.ObjectId, enqueue: bool=True):
+    identitymap.discard('record')
     coll = db.Collection('record')
     doc = await coll.find_one_and_update(filter={'_id': record_id},
-                                         update={'$unset': {'judge_uid': '',
-                                                            'judge_at': '',
-                                                            'compiler_texts': '',
-                                                            'judge_texts': '',
-                                                            'cases': ''},
-                                                 '$set': {'status': constant.record.STATUS_WAITING,
-                                                          'time_ms': 0,
-                                                          'memory_kb': 0,
-                                                          'rejudged': True}},
+                                         update=_REJUDGE_UPDATE,
                                          return_document=False)
     post_coros = []
     pdoc = await problem.get(doc['domain_id'], doc['pid'])
@@ -92,23 +110,113 @@ async def rejudge(record_id: objectid.ObjectId, enqueue: bool=True):
 
 
 @argmethod.wrap
-async def rejudge_all():
+async def rejudge_all(restart: bool=False):
+    """Rejudge all records, continuing from where the last run is interrupted unless restart."""
+    if restart:
+        await system.clear_checkpoint('rejudge_all')
+    return await rejudge_multi(get_hidden=True, checkpoint='rejudge_all')
+
+
+async def _rejudge_batch(rdocs):
+    pdict = await problem.get_dict_multi_domain(((rdoc['domain_id'], rdoc['pid']) for rdoc in rdocs),
+                                                projection={'domain_id': 1, 'judge_mode': 1})
+    rids, answer_rids = [], []
+    for rdoc in rdocs:
+        pdoc = pdict.get((rdoc['domain_id'], rdoc['pid']))
+        if pdoc and pdoc['judge_mode'] == constant.record.MODE_SUBMIT_ANSWER:
+            answer_rids.append(rdoc['_id'])
+        else:
+            rids.append(rdoc['_id'])
+    if rids:
+        identitymap.discard('record')
+        coll = db.Collection('record')
+        await coll.update_many({'_id': {'$in': rids}}, _REJUDGE_UPDATE)
+        await queue.publish_many('judge', [{'rid': rid} for rid in rids])
+        await bus.publish('record_rejudge', json.encode({'count': len(rids), 'rids': rids}))
+    # Answers are judged right here, which needs the code of each record.
+    for rid in answer_rids:
+        await rejudge(rid)
+
+
+async def rejudge_multi(get_hidden: bool=False, on_progress=None, checkpoint: str=None, **kwargs):
+    """Rejudge records in batches.
+
+    Each batch of records is reset by one update, enqueued on one channel and announced
+    by one record_rejudge bus event, instead of a record_change event per record. At most
+    rejudge_concurrency batches are processed at the same time.
+
+    Args:
+        get_hidden: whether to rejudge hidden records.
+        on_progress: function called with (done, total, throughput) after each batch.
+        checkpoint: name of the checkpoint. If given, records are processed in the order
+            of _id, the last _id done is saved after each batch, and an interrupted run
+            continues from there.
+        **kwargs: query of records.
+
+    Returns:
+        Dict of the number of records rejudged, seconds elapsed and throughput.
+    """
+    query = {**kwargs, 'hidden': False if not get_hidden else {'$gte': False}}
+    if checkpoint:
+        begin_id = await system.get_checkpoint(checkpoint)
+        if begin_id:
+            _logger.info('Resuming %s after record %s.', checkpoint, begin_id)
+            query['_id'] = {'$gt': begin_id}
     coll = db.Collection('record')
-    records = await coll.find().to_list(None)
-    for record in records:
-        await rejudge(record['_id'])
+    total = await coll.find(query).count()
+    batch_size = options.options.rejudge_batch_size
+    done = 0
+    begin_at = time.perf_counter()
+    tasks = collections.deque()  # (rdocs, task) in the order of records
+
+    async def finish_oldest():
+        nonlocal done
+        rdocs, task = tasks.popleft()
+        await task
+        done += len(rdocs)
+        if checkpoint:
+            await system.set_checkpoint(checkpoint, rdocs[-1]['_id'])
+        throughput = done / max(time.perf_counter() - begin_at, 1e-6)
+        _logger.info('Rejudged %d/%d records (%.1f records/s).', done, total, throughput)
+        if on_progress:
+            on_progress(done, total, throughput)
+
+    cursor = coll.find(query, projection={'_id': 1, 'domain_id': 1, 'pid': 1})
+    if checkpoint:
+        cursor = cursor.sort('_id', 1)
+    rdocs = []
+    try:
+        async for rdoc in cursor:
+            rdocs.append(rdoc)
+            if len(rdocs) >= batch_size:
+                tasks.append((rdocs, asyncio.ensure_future(_rejudge_batch(rdocs))))
+                rdocs = []
+                while len(tasks) >= options.options.rejudge_concurrency:
+                    await finish_oldest()
+        if rdocs:
+            tasks.append((rdocs, asyncio.ensure_future(_rejudge_batch(rdocs))))
+        while tasks:
+            await finish_oldest()
+    finally:
+        # Only left on error, stop the batches after the checkpoint.
+        for _, task in tasks:
+            task.cancel()
+    if checkpoint:
+        await system.clear_checkpoint(checkpoint)
+    seconds = time.perf_counter() - begin_at
+    return {'count': done, 'seconds': seconds, 'throughput': done / max(seconds, 1e-6)}
 
 
 @argmethod.wrap
 async def rejudge_for_contest(domain_id: str, tid: int):
-    async for rdoc in get_multi(domain_id=domain_id, tid=tid, type=constant.record.TYPE_SUBMISSION):
-        await rejudge(rdoc['_id'])
+    return await rejudge_multi(get_hidden=True, domain_id=domain_id, tid=tid,
+                               type=constant.record.TYPE_SUBMISSION)
 
 
 @argmethod.wrap
 async def rejudge_problem_for_contest(domain_id: str, tid: int, pid: int):
-    async for rdoc in get_multi(domain_id=domain_id, tid=tid, pid=pid, type=constant.record.TYPE_SUBMISSION):
-        await rejudge(rdoc['_id'])
+    return await rejudge_multi(get_hidden=True, domain_id=domain_id, tid=tid, pid=pid,
+                               type=constant.record.TYPE_SUBMISSION)
 
 
 @argmethod.wrap
@@ -136,6 +244,50 @@ async def get_count(begin_id: objectid.ObjectId=None):
     return await coll.find(query).count()
 
 
+def _stat_hour(at):
+    return datetime.datetime(at.year, at.month, at.day, at.hour)
+
+
+async def inc_stat(key: str, at: datetime.datetime=None):
+    """Increase a counter of the hourly judge statistics, e.g. submit or status.<status>."""
+    coll = db.Collection('record.stat')
+    await coll.update_one({'_id': _stat_hour(at or datetime.datetime.utcnow())},
+                          {'$inc': {key: 1}}, upsert=True)
+
+
+@argmethod.wrap
+async def get_stat_count(key: str='submit', begin_at: datetime.datetime=None):
+    """Get the sum of a counter of the hourly judge statistics since the hour of begin_at."""
+    coll = db.Collection('record.stat')
+    match = {'_id': {'$gte': _stat_hour(begin_at)}} if begin_at else {}
+    result = await coll.aggregate([{'$match': match},
+                                   {'$group': {'_id': None, 'count': {'$sum': '$' + key}}}]).to_list(None)
+    return result[0]['count'] if result else 0
+
+
+@argmethod.wrap
+async def rebuild_stat():
+    """Rebuild the hourly judge statistics from all records.
+
+    Records added while rebuilding may be missed or counted twice, so it is expected to be run
+    once when there is no statistics yet.
+    """
+    stats = collections.defaultdict(collections.Counter)  # hour -> counter
+    async for rdoc in db.Collection('record').find({}, projection={'status': 1}):
+        stat = stats[_stat_hour(rdoc['_id'].generation_time)]
+        stat['submit'] += 1
+        if rdoc['status'] != constant.record.STATUS_WAITING:
+            stat['status.{0}'.format(rdoc['status'])] += 1
+    coll = db.Collection('record.stat')
+    await coll.delete_many({})
+    for hour, stat in stats.items():
+        sdoc = {'_id': hour, 'submit': stat.pop('submit'), 'status': {}}
+        for key, count in stat.items():
+            sdoc['status'][key.split('.', 1)[1]] = count
+        await coll.insert_one(sdoc)
+    return len(stats)
+
+
 @argmethod.wrap
 def get_problem_multi(domain_id: str, pid: int, get_hidden: bool=False, type: int=None, *, projection=None):
     coll = db.Collection('record')
@@ -157,14 +309,20 @@ def get_user_in_problem_multi(uid: int, domain_id: str, pid: int, get_hidden: bo
     return coll.find(query, projection=projection)
 
 
-async def get_dict(rids, *, get_hidden: bool=False, projection=None):
-    query = {'_id': {'$in': list(set(rids))}}
+async def _load_dict(rids, get_hidden, projection):
     result = dict()
-    async for rdoc in get_multi(**query, get_hidden=get_hidden, projection=projection):
+    async for rdoc in get_multi(_id={'$in': rids}, get_hidden=get_hidden, projection=projection):
         result[rdoc['_id']] = rdoc
     return result
 
 
+_loader = identitymap.BatchLoader('record', _load_dict)
+
+
+async def get_dict(rids, *, get_hidden: bool=False, projection=None):
+    return await _loader.load_many(rids, get_hidden, projection)
+
+
 @argmethod.wrap
 async def begin_judge(record_id: objectid.ObjectId, judge_uid: int, status: int):
     coll = db.Collection('record')
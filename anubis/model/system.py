@@ -47,6 +47,31 @@ async def inc_contest_counter():
     return doc['value']
 
 
+@argmethod.wrap
+async def get_checkpoint(name: str):
+    """Get the checkpoint of a resumable job.
+
+    Returns:
+        The value of the checkpoint, or None if the job is not interrupted.
+    """
+    coll = db.Collection('system')
+    doc = await coll.find_one({'_id': 'checkpoint-' + name})
+    return doc['value'] if doc else None
+
+
+async def set_checkpoint(name: str, value):
+    coll = db.Collection('system')
+    await coll.update_one({'_id': 'checkpoint-' + name},
+                          {'$set': {'value': value}},
+                          upsert=True)
+
+
+@argmethod.wrap
+async def clear_checkpoint(name: str):
+    coll = db.Collection('system')
+    await coll.delete_one({'_id': 'checkpoint-' + name})
+
+
 @argmethod.wrap
 async def create_indexes():
     coll = db.Collection('system')
@@ -1,11 +1,26 @@
+import hashlib
+
 from bson import objectid
 
 from anubis import db
 from anubis.util import argmethod
+from anubis.util import json
+from anubis.util import lrucache
+from anubis.util import options
+
+options.define('testdata_cache_max_bytes', default=128 * 1024 * 1024,
+               help='Maximum size in bytes of test data cached in memory.')
 
 TYPE_TEST_DATA = 1
 TYPE_PRETEST_DATA = 2
 
+_cache = lrucache.LRUCache(options.options.testdata_cache_max_bytes)  # (did, md5) -> doc
+
+
+def get_md5(data):
+    """Get the content hash of test data, which is the version seen by judges."""
+    return hashlib.md5(json.encode(data).encode()).hexdigest()
+
 
 @argmethod.wrap
 async def add(domain_id: str, data: list, owner_uid: int, type: int, pid: int, **kwargs):
@@ -16,6 +31,7 @@ async def add(domain_id: str, data: list, owner_uid: int, type: int, pid: int, *
         'domain_id': domain_id,
         'type': type,
         'pid': pid,
+        'md5': get_md5(data),
         **kwargs
     }
     return await coll.insert(doc)
@@ -28,8 +44,32 @@ async def get(domain_id: str, did: objectid.ObjectId):
                                 '_id': did})
 
 
+async def get_cached(domain_id: str, did: objectid.ObjectId, md5: str=None):
+    """Get test data through the in-memory cache.
+
+    Entries are keyed by the data id and its content hash, so a changed document is never
+    served from the cache. Without a known hash, e.g. for data added before hashes are stored,
+    the document is read without the cache.
+    """
+    if not md5:
+        return await get(domain_id, did)
+    doc = _cache.get((did, md5))
+    if doc and doc['domain_id'] == domain_id:
+        return doc
+    doc = await get(domain_id, did)
+    if doc and doc.get('md5') == md5:
+        _cache.set((did, md5), doc)
+    return doc
+
+
+def get_cache_stats():
+    return _cache.stats()
+
+
 @argmethod.wrap
 async def edit(domain_id: str, did: objectid.ObjectId, **kwargs):
+    if 'data' in kwargs:
+        kwargs['md5'] = get_md5(kwargs['data'])
     coll = db.Collection('testdata')
     doc = await coll.find_one_and_update(filter={'domain_id': domain_id,
                                                  '_id': did},
@@ -3,10 +3,16 @@ import datetime
 import hashlib
 import os
 
+import aioredis
+
 from anubis.util import argmethod
 from anubis.util import json
+from anubis.util import options
 from anubis import redis
 
+options.define('token_update_granularity_seconds', default=60,
+               help='Minimum interval in seconds to rewrite a token which is not changed.')
+
 TYPE_REGISTRATION = 1
 TYPE_SAVED_SESSION = 2
 TYPE_UNSAVED_SESSION = 3
@@ -14,10 +20,51 @@ TYPE_LOSTPASS = 4
 TYPE_CHANGEMAIL = 5
 
 
+_TIME_FIELDS = ['create_at', 'update_at', 'expire_at']
+
+
 def _get_id(id_binary):
     return hashlib.sha256(id_binary).digest()
 
 
+def _encode(doc):
+    """Encode a token document to hash fields, each field is a JSON value."""
+    return dict((key, json.encode(value)) for key, value in doc.items())
+
+
+def _decode(fields):
+    return _decode_times(dict((key, json.decode(value)) for key, value in fields.items()))
+
+
+def _decode_times(doc):
+    """Convert the time fields of a decoded token document from milliseconds to datetimes."""
+    for key in _TIME_FIELDS:
+        if key in doc:
+            doc[key] = datetime.datetime.utcfromtimestamp(doc[key] / 1000)
+    return doc
+
+
+async def _write(key, fields, expire_seconds, replace=False):
+    """Write hash fields of a token and refresh its expiry in one round trip."""
+    transaction = await redis.transaction()
+    if replace:
+        transaction.delete(key)
+    transaction.hmset_dict(key, fields)
+    transaction.expire(key, expire_seconds)
+    await transaction.execute()
+
+
+async def _get(db, key):
+    """Get a token document, and whether it is stored as a hash."""
+    try:
+        fields = await db.hgetall(key, encoding='utf-8')
+        return (_decode(fields), True) if fields else (None, True)
+    except aioredis.ReplyError:
+        # Tokens written before sessions are stored as hashes are JSON strings.
+        value = await db.get(key, encoding='utf-8')
+        return (_decode_times(json.decode(value)), False) if value else (None, False)
+
+
 @argmethod.wrap
 async def add(token_type: int, expire_seconds: int, **kwargs):
     """Add a token.
@@ -41,8 +88,7 @@ async def add(token_type: int, expire_seconds: int, **kwargs):
         'update_at': now,
         'expire_at': now + datetime.timedelta(seconds=expire_seconds)
     }
-    db = await redis.database()
-    await db.set('token_' + id_hash, json.encode(doc), expire=expire_seconds)
+    await _write('token_' + id_hash, _encode(doc), expire_seconds)
     return id_hash, doc
 
 
@@ -57,11 +103,8 @@ async def get(token_id: str, token_type: int):
         The token document, or None.
     """
     db = await redis.database()
-    doc = await db.get('token_' + token_id)
-    if doc:
-        return json.decode(doc.decode())
-    else:
-        return None
+    doc, _ = await _get(db, 'token_' + token_id)
+    return doc
 
 
 @argmethod.wrap
@@ -81,20 +124,30 @@ async def update(token_id: str, token_type: int, expire_seconds: int, replace: b
     db = await redis.database()
     assert 'token_type' not in kwargs
     now = datetime.datetime.utcnow()
-    doc = await get(token_id, token_type)
+    key = 'token_' + token_id
+    doc, is_hash = await _get(db, key)
     if not doc:
         return None
     if not replace:
-        doc.update({**kwargs,
-                    'token_type': token_type,
-                    'update_at': now,
-                    'expire_at': now + datetime.timedelta(seconds=expire_seconds)})
+        changes = dict((k, v) for k, v in kwargs.items() if doc.get(k) != v)
+        granularity = datetime.timedelta(seconds=options.options.token_update_granularity_seconds)
+        if (is_hash and not changes and doc.get('token_type') == token_type
+                and now - doc['update_at'] < granularity):
+            # Only update_at and the expiry would change, which are not worth a write.
+            return doc
+        changes.update({'token_type': token_type,
+                        'update_at': now,
+                        'expire_at': now + datetime.timedelta(seconds=expire_seconds)})
+        doc.update(changes)
+        if not is_hash:
+            changes = doc
     else:
         doc = {**kwargs,
                'token_type': token_type,
                'update_at': now,
                'expire_at': now + datetime.timedelta(seconds=expire_seconds)}
-    await db.set('token_' + token_id, json.encode(doc), expire=expire_seconds)
+        changes = doc
+    await _write(key, _encode(changes), expire_seconds, replace=replace or not is_hash)
     return doc
 
 
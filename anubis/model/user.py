@@ -6,7 +6,9 @@ from anubis import db
 from anubis import error
 from anubis.model import builtin
 from anubis.model import system
+from anubis.service import executor
 from anubis.util import argmethod
+from anubis.util import identitymap
 from anubis.util import pwhash
 from anubis.util import validator
 
@@ -18,10 +20,27 @@ PROJECTION_PUBLIC = {
     'gravatar': 1
 }
 
+PROJECTION_LIST = {
+    '_id': 1,
+    'uname': 1,
+    'nickname': 1,
+    'gravatar': 1,
+    'avatar': 1,
+    'priv': 1
+}
+
 PROJECTION_VIEW = {'salt': 0, 'hash': 0}
 PROJECTION_ALL = None
 
 
+async def _hash_password(password, salt):
+    return await executor.run(executor.TYPE_PWHASH, pwhash.hash_password, password, salt)
+
+
+async def _check_password(password, doc):
+    return await executor.run(executor.TYPE_PWHASH, pwhash.check, password, doc['salt'], doc['hash'])
+
+
 @argmethod.wrap
 async def add(uname: str, password: str, mail: str, reg_ip: str='',
               uid: int=None, priv: int=builtin.DEFAULT_PRIV, **kwargs):
@@ -41,6 +60,7 @@ async def add(uname: str, password: str, mail: str, reg_ip: str='',
             raise error.UserAlreadyExistError(uname)
 
     salt = pwhash.gen_salt()
+    identitymap.discard('user')
     coll = db.Collection('user')
     try:
         return (await coll.insert_one({
@@ -50,7 +70,7 @@ async def add(uname: str, password: str, mail: str, reg_ip: str='',
             'mail': mail,
             'mail_lower': mail_lower,
             'salt': salt,
-            'hash': pwhash.hash_password(password, salt),
+            'hash': await _hash_password(password, salt),
             'reg_at': datetime.datetime.utcnow(),
             'reg_ip': reg_ip,
             'priv': priv,
@@ -64,6 +84,7 @@ async def add(uname: str, password: str, mail: str, reg_ip: str='',
 
 
 async def update(uid: int, **kwargs):
+    identitymap.discard('user')
     coll = db.Collection('user')
     return await coll.find_one_and_update(filter={'_id': uid},
                                           update={'$set': kwargs},
@@ -75,8 +96,7 @@ async def get_by_uid(uid: int, fields=PROJECTION_VIEW):
     for user in builtin.USERS:
         if user['_id'] == uid:
             return user
-    coll = db.Collection('user')
-    return await coll.find_one({'_id': uid}, fields)
+    return await _loader.load(uid, fields)
 
 
 @argmethod.wrap
@@ -104,24 +124,31 @@ def get_multi(*, fields=PROJECTION_VIEW, **kwargs):
     return coll.find(kwargs, fields)
 
 
-async def get_dict(uids, *, fields=PROJECTION_VIEW):
+async def _load_dict(uids, fields):
     result = dict()
-    async for doc in get_multi(_id={'$in': list(set(uids))}, fields=fields):
+    async for doc in get_multi(_id={'$in': uids}, fields=fields):
         result[doc['_id']] = doc
     return result
 
 
+_loader = identitymap.BatchLoader('user', _load_dict)
+
+
+async def get_dict(uids, *, fields=PROJECTION_VIEW):
+    return await _loader.load_many(uids, fields)
+
+
 @argmethod.wrap
 async def check_password_by_uid(uid: int, password: str):
     doc = await get_by_uid(uid, PROJECTION_ALL)
-    if doc and pwhash.check(password, doc['salt'], doc['hash']):
+    if doc and await _check_password(password, doc):
         return doc
 
 
 @argmethod.wrap
 async def check_password_by_uname(uname: str, password: str):
     doc = await get_by_uname(uname, PROJECTION_ALL)
-    if doc and pwhash.check(password, doc['salt'], doc['hash']):
+    if doc and await _check_password(password, doc):
         return doc
 
 
@@ -129,10 +156,11 @@ async def check_password_by_uname(uname: str, password: str):
 async def set_password(uid: int, password: str):
     validator.check_password(password)
     salt = pwhash.gen_salt()
+    identitymap.discard('user')
     coll = db.Collection('user')
     doc = await coll.find_one_and_update(filter={'_id': uid},
                                          update={'$set': {'salt': salt,
-                                                          'hash': pwhash.hash_password(password, salt)}},
+                                                          'hash': await _hash_password(password, salt)}},
                                          return_document=True)
     return doc
 
@@ -147,10 +175,11 @@ async def set_mail(uid: int, mail: str):
 async def change_password(uid: int, password: str):
     validator.check_password(password)
     salt = pwhash.gen_salt()
+    identitymap.discard('user')
     coll = db.Collection('user')
     doc = await coll.find_one_and_update(filter={'_id': uid},
                                          update={'$set': {'salt': salt,
-                                                          'hash': pwhash.hash_password(password, salt)}},
+                                                          'hash': await _hash_password(password, salt)}},
                                          return_document=True)
     return doc
 
@@ -168,17 +197,19 @@ async def change_password(uid: int, current_password: str, password: str):
         return None
     validator.check_password(password)
     salt = pwhash.gen_salt()
+    identitymap.discard('user')
     coll = db.Collection('user')
     doc = await coll.find_one_and_update(filter={'_id': doc['_id'],
                                                  'salt': doc['salt'],
                                                  'hash': doc['hash']},
                                          update={'$set': {'salt': salt,
-                                                          'hash': pwhash.hash_password(password, salt)}},
+                                                          'hash': await _hash_password(password, salt)}},
                                          return_document=True)
     return doc
 
 
 async def set_by_uid(uid, **kwargs):
+    identitymap.discard('user')
     coll = db.Collection('user')
     doc = await coll.find_one_and_update(filter={'_id': uid}, update={'$set': kwargs}, return_document=True)
     return doc
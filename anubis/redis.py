@@ -1,3 +1,6 @@
+import asyncio
+import logging
+
 import aioredis
 
 from anubis.util import options
@@ -6,19 +9,59 @@ from anubis.util import options
 options.define('redis_host', default='localhost', help='Redis hostname or IP address.')
 options.define('redis_port', default=6379, help='Redis port.')
 options.define('redis_index', default=1, help='Redis database index.')
+options.define('redis_min_connections', default=1, help='Minimum number of Redis connections.')
+options.define('redis_max_connections', default=16, help='Maximum number of Redis connections.')
 
-_connection = None
+_logger = logging.getLogger(__name__)
+_pool = None  # future of the Redis client on a connection pool
+_reconnects = 0
 
 
-async def _create_connect():
-    global _connection
-    if not _connection:
-        _connection = await aioredis.create_redis(
+async def _create_pool():
+    global _pool, _reconnects
+    if _pool and _pool.done() and (_pool.exception() or _pool.result().closed):
+        _logger.warning('Redis connection pool closed, reconnecting.')
+        _pool = None
+        _reconnects += 1
+    if not _pool:
+        # Concurrent callers wait for the same pool instead of creating their own.
+        _pool = asyncio.ensure_future(aioredis.create_redis_pool(
             (options.options.redis_host, options.options.redis_port),
-            db=options.options.redis_index
-        )
-    return _connection
+            db=options.options.redis_index,
+            minsize=options.options.redis_min_connections,
+            maxsize=options.options.redis_max_connections
+        ))
+    return await asyncio.shield(_pool)
 
 
 async def database():
-    return await _create_connect()
+    """Get the Redis client.
+
+    Commands acquire a connection from the pool. Broken connections are replaced by the pool,
+    and a closed pool is recreated.
+    """
+    return await _create_pool()
+
+
+async def transaction():
+    """Get a MULTI/EXEC transaction, the buffered commands are sent in one round trip by execute()."""
+    return (await database()).multi_exec()
+
+
+async def ping():
+    """Check the connection to Redis. Returns True if it is alive."""
+    try:
+        return await (await database()).ping() == b'PONG'
+    except (aioredis.RedisError, OSError) as e:
+        _logger.warning('Redis ping failed: %s', repr(e))
+        return False
+
+
+def get_stats():
+    """Get the utilization of the connection pool."""
+    stats = {'min': options.options.redis_min_connections, 'max': options.options.redis_max_connections,
+             'size': 0, 'free': 0, 'in_use': 0, 'reconnects': _reconnects}
+    if _pool and _pool.done() and not _pool.exception():
+        pool = _pool.result().connection
+        stats.update({'size': pool.size, 'free': pool.freesize, 'in_use': pool.size - pool.freesize})
+    return stats
@@ -0,0 +1,64 @@
+import time
+
+from anubis.service import bus
+from anubis.util import lrucache
+from anubis.util import options
+
+options.define('count_cache_ttl_seconds', default=30,
+               help='Time in seconds a count of documents is cached.')
+options.define('count_cache_max_bytes', default=1024 * 1024,
+               help='Maximum approximate size in bytes of cached counts.')
+
+_cache = lrucache.LRUCache(options.options.count_cache_max_bytes)  # key -> (expire_at, count)
+_generations = {}  # (collection, domain_id) -> generation, bumped on invalidation
+
+
+def _normalize(value):
+    """Get a hashable value of a filter, which is the same regardless of the order of keys."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _normalize(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(v) for v in value)
+    return value
+
+
+async def _on_invalidate(e):
+    key = (e['value']['collection'], e['value']['domain_id'])
+    _generations[key] = _generations.get(key, 0) + 1
+
+
+def init():
+    bus.subscribe(_on_invalidate, ['count_invalidate'])
+
+
+async def get(collection, domain_id, query, load):
+    """Get the count of documents matching a filter, counting it by load() if not cached."""
+    generation = _generations.get((collection, domain_id), 0)
+    key = (collection, domain_id, generation, _normalize(query))
+    entry = _cache.get(key)
+    now = time.monotonic()
+    if entry and entry[0] > now:
+        return entry[1]
+    count = await load()
+    _cache.set(key, (now + options.options.count_cache_ttl_seconds, count))
+    return count
+
+
+async def invalidate(collection, domain_id):
+    """Drop cached counts of a collection in a domain in all workers.
+
+    Called after documents are added, deleted, or changed in a field used by filters.
+    """
+    value = {'collection': collection, 'domain_id': domain_id}
+    await _on_invalidate({'value': value})
+    await bus.publish('count_invalidate', value)
+
+
+def get_stats():
+    return _cache.stats()
+
+
+def uninit():
+    bus.unsubscribe(_on_invalidate)
+    _cache.clear()
+    _generations.clear()
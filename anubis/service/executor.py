@@ -0,0 +1,106 @@
+"""Executor running CPU-heavy work off the event loop.
+
+Each type of work has its own limit of concurrent tasks, so that e.g. exports cannot hold all
+the threads needed by logins. Work which holds the GIL runs in processes if executor_processes
+is set, other work runs in threads.
+"""
+import asyncio
+import collections
+from concurrent import futures
+
+from anubis.util import options
+
+options.define('executor_threads', default=4, help='Number of threads of the executor.')
+options.define('executor_processes', default=0,
+               help='Number of processes for work holding the GIL, which runs in threads if 0.')
+options.define('executor_pwhash_limit', default=4, help='Maximum number of concurrent password hashes.')
+options.define('executor_zip_limit', default=2, help='Maximum number of concurrent ZIP compressions.')
+options.define('executor_pdf_limit', default=1, help='Maximum number of concurrent PDF renderings.')
+options.define('executor_ocr_limit', default=1, help='Maximum number of concurrent OCR recognitions.')
+
+TYPE_PWHASH = 'pwhash'
+TYPE_ZIP = 'zip'
+TYPE_PDF = 'pdf'
+TYPE_OCR = 'ocr'
+
+# type -> (option of the limit, whether the work holds the GIL)
+_TYPES = {
+    TYPE_PWHASH: ('executor_pwhash_limit', False),
+    TYPE_ZIP: ('executor_zip_limit', False),
+    TYPE_PDF: ('executor_pdf_limit', True),
+    TYPE_OCR: ('executor_ocr_limit', False),
+}
+
+_thread_pool = None
+_process_pool = None
+_semaphores = {}
+_stats = collections.defaultdict(collections.Counter)  # type -> counter
+
+
+def _get_executor(type):
+    global _thread_pool, _process_pool
+    if _TYPES[type][1] and options.options.executor_processes > 0:
+        if not _process_pool:
+            _process_pool = futures.ProcessPoolExecutor(options.options.executor_processes)
+        return _process_pool
+    if not _thread_pool:
+        _thread_pool = futures.ThreadPoolExecutor(options.options.executor_threads)
+    return _thread_pool
+
+
+async def run(type, func, *args):
+    """Run func(*args) in the executor and return its result.
+
+    Waits while the limit of the type is reached. In a process func and args must be picklable.
+    """
+    semaphore = _semaphores.get(type)
+    if not semaphore:
+        semaphore = _semaphores[type] = asyncio.Semaphore(getattr(options.options, _TYPES[type][0]))
+    stats = _stats[type]
+    stats['waiting'] += 1
+    stats['max_waiting'] = max(stats['max_waiting'], stats['waiting'])
+    try:
+        await semaphore.acquire()
+    finally:
+        stats['waiting'] -= 1
+    stats['running'] += 1
+
+    def done(future):
+        stats['running'] -= 1
+        if future.cancelled() or future.exception():
+            stats['failed'] += 1
+        else:
+            stats['completed'] += 1
+        semaphore.release()
+
+    try:
+        future = asyncio.get_event_loop().run_in_executor(_get_executor(type), func, *args)
+    except Exception:
+        stats['running'] -= 1
+        stats['failed'] += 1
+        semaphore.release()
+        raise
+    # The slot is held until the work is done, even if the caller is cancelled.
+    future.add_done_callback(done)
+    return await asyncio.shield(future)
+
+
+def get_stats():
+    """Get the limit and the numbers of waiting, running, completed and failed tasks of each type."""
+    return dict((type, {'limit': getattr(options.options, option),
+                        'waiting': _stats[type]['waiting'],
+                        'max_waiting': _stats[type]['max_waiting'],
+                        'running': _stats[type]['running'],
+                        'completed': _stats[type]['completed'],
+                        'failed': _stats[type]['failed']})
+                for type, (option, _) in _TYPES.items())
+
+
+def uninit():
+    global _thread_pool, _process_pool
+    for pool in [_thread_pool, _process_pool]:
+        if pool:
+            pool.shutdown(wait=False)
+    _thread_pool = None
+    _process_pool = None
+    _semaphores.clear()
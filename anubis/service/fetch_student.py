@@ -4,6 +4,7 @@ from urllib import parse
 from bs4 import BeautifulSoup
 
 from anubis import error
+from anubis.service import executor
 from anubis.util import argmethod
 from anubis.util import options
 from anubis.util import ocr
@@ -33,7 +34,7 @@ async def _login():
 
     for _ in range(5):
         bin_image = await _get_captcha_image()
-        captcha = ocr.recognize_digits(bin_image)
+        captcha = await executor.run(executor.TYPE_OCR, ocr.recognize_digits, bin_image)
         if not captcha:
             continue
         async with _session.post(login_url, data={'WebUserNO': options.options.school_teacher_username,
@@ -0,0 +1,306 @@
+import asyncio
+import bisect
+import collections
+import hashlib
+import logging
+
+from anubis.model import contest
+from anubis.service import bus
+from anubis.util import json
+from anubis.util import options
+
+options.define('scoreboard_max_contests', default=16,
+               help='Maximum number of contests kept in scoreboard index.')
+options.define('scoreboard_reload_seconds', default=60,
+               help='Interval in seconds to reload scoreboards from the database, which corrects '
+                    'changes missed by the bus.')
+
+_logger = logging.getLogger(__name__)
+_reload_task = None
+_boards = collections.OrderedDict()  # (domain_id, tid) -> (Scoreboard, future of Scoreboard)
+_snapshots = collections.OrderedDict()  # (domain_id, tid, lock_at) -> future of Scoreboard
+
+
+def _key(tsdoc):
+    return -tsdoc.get('accept', 0), tsdoc.get('time', 0.0), tsdoc['uid']
+
+
+def _stamp(tsdoc):
+    digest = hashlib.md5('{0}:{1}'.format(tsdoc['uid'], tsdoc.get('rev', 0)).encode()).digest()
+    return int.from_bytes(digest[:6], 'big')
+
+
+class Scoreboard(object):
+    """Ranked index of the status documents of a contest.
+
+    Status documents are kept sorted by (accept desc, time asc, uid). Ranks are
+    calculated lazily by the rank function of the contest rule, and only once per change.
+
+    The version is the XOR of a hash of (uid, rev) of all status documents, so it is changed
+    by every change and is the same in every worker for the same content.
+    """
+
+    def __init__(self, domain_id, tid):
+        self.domain_id = domain_id
+        self.tid = tid
+        self.tdoc = None
+        self.version = 0
+        self.keys = []
+        self.tsdocs = {}  # uid -> tsdoc
+        self.watchers = set()
+        self._ranked = None
+        self._positions = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def load(self, tdoc, tsdocs):
+        self.tdoc = tdoc
+        for tsdoc in tsdocs:
+            # Keep the same types as the documents received from bus, e.g. rid as str.
+            self.update(json.decode(json.encode(tsdoc)))
+
+    def update(self, tsdoc):
+        """Insert or replace the status document of a user. Returns False if it is outdated."""
+        old_tsdoc = self.tsdocs.get(tsdoc['uid'])
+        if old_tsdoc:
+            if tsdoc.get('rev', 0) < old_tsdoc.get('rev', 0):
+                return False
+            del self.keys[bisect.bisect_left(self.keys, _key(old_tsdoc))]
+            self.version ^= _stamp(old_tsdoc)
+        bisect.insort(self.keys, _key(tsdoc))
+        self.tsdocs[tsdoc['uid']] = tsdoc
+        self.version ^= _stamp(tsdoc)
+        self._ranked = None
+        return True
+
+    def remove(self, uid):
+        tsdoc = self.tsdocs.pop(uid, None)
+        if tsdoc:
+            del self.keys[bisect.bisect_left(self.keys, _key(tsdoc))]
+            self.version ^= _stamp(tsdoc)
+            self._ranked = None
+
+    def _rank(self):
+        if self._ranked is None:
+            rank_func = contest.RULES[self.tdoc['rule']].rank_func
+            # Copy the documents since the rank function marks prizes on them.
+            self._ranked = list(rank_func(dict(self.tsdocs[key[2]]) for key in self.keys))
+            self._positions = dict((tsdoc['uid'], index)
+                                   for index, (_, tsdoc) in enumerate(self._ranked))
+        return self._ranked
+
+    def get_slice(self, begin, end):
+        """Get a list of (rank, tsdoc) in [begin, end) of the ranking."""
+        return self._rank()[begin:end]
+
+    def _index(self, tsdoc):
+        """Get the index of a status document in the ranking, without ranking."""
+        return bisect.bisect_left(self.keys, _key(tsdoc)) if tsdoc else None
+
+    def get_deltas(self, moves, old_ranked, old_positions):
+        """Get the changes of the ranking caused by a batch of changes of users.
+
+        Args:
+            moves: list of (uid, old tsdoc, old index, index) in the order the changes are
+                applied, where the indices are the positions of the user right before and
+                after its own change, so that the moves can be replayed one by one.
+            old_ranked, old_positions: the ranking before the batch.
+
+        Returns:
+            One delta per move, with the new accept and time of the user, the problem details
+            which are changed, and its old and new index. [uid, rank, prize] of the users whose
+            rank or prize are changed by the batch are carried by the last delta.
+        """
+        ranked = self._rank()
+        deltas = []
+        begin = len(ranked)
+        for uid, old_tsdoc, old_index, index in moves:
+            delta = {'type': 'rank_changed', 'uid': uid, 'old_index': old_index, 'index': index,
+                     'ranks': []}
+            if index is not None:
+                tsdoc = ranked[self._positions[uid]][1]
+                old_details = dict((d['pid'], d) for d in (old_tsdoc or {}).get('detail', []))
+                delta.update({'accept': tsdoc.get('accept', 0),
+                              'time': tsdoc.get('time', 0.0),
+                              'detail': [d for d in tsdoc.get('detail', [])
+                                         if old_details.get(d['pid']) != d]})
+            begin = min([begin] + [i for i in (old_index, index) if i is not None])
+            deltas.append(delta)
+        # Users before all the moves keep their index, so are their ranks and prizes.
+        for rank, tsdoc in ranked[begin:]:
+            old_position = old_positions.get(tsdoc['uid'])
+            if old_position is not None:
+                old_rank, old_tsdoc = old_ranked[old_position]
+                if rank == old_rank and tsdoc.get('prize') == old_tsdoc.get('prize'):
+                    continue
+            deltas[-1]['ranks'].append([tsdoc['uid'], rank, tsdoc.get('prize')])
+        return deltas
+
+    def watch(self, callback):
+        """Watch the deltas of the ranking with a coroutine function."""
+        self.watchers.add(callback)
+
+    def unwatch(self, callback):
+        self.watchers.discard(callback)
+
+    async def on_notification(self, e):
+        value = json.decode(e['value'])
+        if value.get('type') != 'rank_changed':
+            return
+        await self.apply(list(zip(value['uids'], value['tsdocs'])))
+
+    async def reload(self):
+        """Apply the differences from the status documents in the database."""
+        tsdocs = dict(self.tsdocs)
+        tdoc, new_tsdocs = await contest.get_and_list_status(self.domain_id, self.tid,
+                                                             projection={'journal': 0})
+        self.tdoc = tdoc
+        new_tsdocs = dict((tsdoc['uid'], json.decode(json.encode(tsdoc))) for tsdoc in new_tsdocs)
+        changes = [(uid, tsdoc) for uid, tsdoc in new_tsdocs.items()
+                   if uid not in self.tsdocs or tsdoc.get('rev', 0) != self.tsdocs[uid].get('rev', 0)]
+        # Users added by the bus while reading are kept.
+        changes.extend((uid, None) for uid, tsdoc in tsdocs.items()
+                       if uid not in new_tsdocs and self.tsdocs.get(uid) is tsdoc)
+        if changes:
+            _logger.warning('Scoreboard of %s/%s is corrected by %d reloaded users',
+                            self.domain_id, self.tid, len(changes))
+            await self.apply(changes)
+
+    async def apply(self, changes):
+        """Apply a batch of (uid, tsdoc or None to remove) and send the deltas to watchers."""
+        watched = self.watchers and self.tdoc
+        if watched:
+            old_ranked, old_positions = self._rank(), self._positions
+        # The batch is ranked once after all changes are applied.
+        moves = []
+        for uid, tsdoc in changes:
+            old_tsdoc = self.tsdocs.get(uid)
+            old_index = self._index(old_tsdoc)
+            if tsdoc:
+                changed = self.update(tsdoc)
+            else:
+                changed = old_tsdoc is not None
+                self.remove(uid)
+            if changed:
+                moves.append((uid, old_tsdoc, old_index, self._index(self.tsdocs.get(uid))))
+        if not watched or not moves:
+            return
+        for delta in self.get_deltas(moves, old_ranked, old_positions):
+            await asyncio.gather(*[watcher(delta) for watcher in list(self.watchers)])
+
+
+def _evict():
+    # Boards being watched are never evicted, otherwise their watchers stop receiving deltas.
+    # Boards still loading are kept for their loaders, which may watch them.
+    for key in list(_boards.keys()):
+        if len(_boards) <= options.options.scoreboard_max_contests:
+            break
+        board, future = _boards[key]
+        if not board.watchers and future.done():
+            del _boards[key]
+            bus.unsubscribe(board.on_notification)
+
+
+async def get(domain_id: str, tid: int, watcher=None):
+    """Get the scoreboard of a contest, loading it on first use.
+
+    Args:
+        watcher: coroutine function to watch the deltas of the board, see Scoreboard.watch().
+            It is added before the board is returned, so that the board is not evicted between.
+    """
+    key = (domain_id, tid)
+    if key in _boards:
+        _boards.move_to_end(key)
+        board, future = _boards[key]
+    else:
+        board = Scoreboard(domain_id, tid)
+        future = asyncio.Future()
+        _boards[key] = (board, future)
+        # Subscribe before loading so that no change is missed, outdated ones are dropped by rev.
+        bus.subscribe(board.on_notification, ['contest_notification-' + str(tid)])
+        _evict()
+        asyncio.ensure_future(_load(key, board, future))
+    if watcher:
+        board.watch(watcher)
+    try:
+        return await asyncio.shield(future)
+    except Exception:
+        if watcher:
+            board.unwatch(watcher)
+        raise
+
+
+def unwatch(domain_id: str, tid: int, watcher):
+    """Stop watching the scoreboard of a contest, which may be still loading."""
+    entry = _boards.get((domain_id, tid))
+    if entry:
+        entry[0].unwatch(watcher)
+
+
+async def _load(key, board, future):
+    try:
+        tdoc, tsdocs = await contest.get_and_list_status(key[0], key[1], projection={'journal': 0})
+        board.load(tdoc, tsdocs)
+        future.set_result(board)
+    except Exception as e:
+        bus.unsubscribe(board.on_notification)
+        future.set_exception(e)
+        if _boards.get(key) == (board, future):
+            del _boards[key]
+
+
+async def _reload():
+    while True:
+        await asyncio.sleep(options.options.scoreboard_reload_seconds)
+        for board, future in list(_boards.values()):
+            if future.done() and not future.exception():
+                try:
+                    await board.reload()
+                except Exception as e:
+                    _logger.exception(e)
+
+
+async def _on_snapshot_change(e):
+    for key in [key for key in _snapshots if key[:2] == (e['value']['domain_id'], e['value']['tid'])]:
+        del _snapshots[key]
+
+
+def init():
+    global _reload_task
+    bus.subscribe(_on_snapshot_change, ['contest_snapshot_change'])
+    _reload_task = asyncio.get_event_loop().create_task(_reload())
+
+
+async def get_snapshot(tdoc):
+    """Get the frozen scoreboard of a contest, materialized at its lock time."""
+    key = (tdoc['domain_id'], tdoc['_id'], tdoc['lock_at'])
+    if key in _snapshots:
+        _snapshots.move_to_end(key)
+        return await _snapshots[key]
+    _snapshots[key] = future = asyncio.Future()
+    while len(_snapshots) > options.options.scoreboard_max_contests:
+        _snapshots.popitem(False)
+    try:
+        snapshot = await contest.get_snapshot(tdoc)
+        board = Scoreboard(tdoc['domain_id'], tdoc['_id'])
+        board.load(tdoc, snapshot['tsdocs'])
+        future.set_result(board)
+        return board
+    except Exception as e:
+        future.set_exception(e)
+        if _snapshots.get(key) is future:
+            del _snapshots[key]
+        raise
+
+
+def uninit():
+    global _reload_task
+    bus.unsubscribe(_on_snapshot_change)
+    if _reload_task:
+        _reload_task.cancel()
+        _reload_task = None
+    for board, _ in _boards.values():
+        bus.unsubscribe(board.on_notification)
+    _boards.clear()
+    _snapshots.clear()
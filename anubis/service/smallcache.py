@@ -1,53 +1,58 @@
-import collections
-import copy
+import types
 
 from anubis.service import bus
+from anubis.util import lrucache
 from anubis.util import options
 
 PREFIX_DISCUSSION_NODES = 'discussion-nodes-'
+PREFIX_DISCUSSION_VNODE = 'discussion-vnode-'
 
-options.define('smallcache_max_entries', default=64,
-               help='Maximum number of entries of smallcache.')
+options.define('smallcache_max_bytes', default=16 * 1024 * 1024,
+               help='Maximum approximate size in bytes of smallcache.')
 
-_cache = collections.OrderedDict()
+_cache = lrucache.LRUCache(options.options.smallcache_max_bytes)
+
+
+def _freeze(value):
+    """Get a read-only version of a value, which can be shared without copying."""
+    if isinstance(value, dict):
+        return types.MappingProxyType(dict((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
 
 
 async def _on_unset(e):
-    if e['value'] in _cache:
-        del _cache[e['value']]
+    _cache.unset(e['value'])
 
 
 def init():
     bus.subscribe(_on_unset, ['smallcache-unset'])
 
 
-def get_direct(key, default=None):
-    if key not in _cache:
-        return default
-    _cache.move_to_end(key)
-    return _cache[key]
-
-
 def get(key, default=None):
-    return copy.deepcopy(get_direct(key, default))
+    """Get a cached value. Values are read-only, dicts are mapping proxies and lists are tuples."""
+    return _cache.get(key, default)
 
 
-def set_local_direct(key, value):
-    if key in _cache:
-        del _cache[key]
-    _cache[key] = value
-    if len(_cache) > options.smallcache_max_entries:
-        _cache.popitem(False)
+def set_local(key, value):
+    _cache.set(key, _freeze(value), lrucache.sizeof(value))
 
 
-def set_local(key, value):
-    set_local_direct(key, copy.deepcopy(value))
+def unset_local(key):
+    _cache.unset(key)
 
 
 async def unset_global(key):
     await bus.publish('smallcache-unset', key)
 
 
+def get_stats():
+    return _cache.stats()
+
+
 def uninit():
     bus.unsubscribe(_on_unset)
     _cache.clear()
@@ -0,0 +1,54 @@
+import asyncio
+import datetime
+import unittest
+
+import aioredis
+
+from anubis.model import token
+from anubis.util import json
+
+DOC = {
+    '_id': 'id',
+    'token_type': token.TYPE_SAVED_SESSION,
+    'uid': 2,
+    'create_at': datetime.datetime(2018, 1, 1),
+    'update_at': datetime.datetime(2018, 1, 1, 0, 0, 30),
+    'expire_at': datetime.datetime(2018, 1, 2),
+}
+
+
+class FakeDatabase(object):
+    def __init__(self, **values):
+        self.values = values
+
+    async def hgetall(self, key, *, encoding=None):
+        value = self.values.get(key, {})
+        if not isinstance(value, dict):
+            raise aioredis.ReplyError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    async def get(self, key, *, encoding=None):
+        value = self.values.get(key)
+        if isinstance(value, dict):
+            raise aioredis.ReplyError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+
+class TokenTest(unittest.TestCase):
+    def get(self, db, key):
+        return asyncio.get_event_loop().run_until_complete(token._get(db, key))
+
+    def test_get_hash(self):
+        db = FakeDatabase(token_id=token._encode(DOC))
+        self.assertEqual(self.get(db, 'token_id'), (DOC, True))
+
+    def test_get_legacy_string(self):
+        db = FakeDatabase(token_id=json.encode(DOC))
+        self.assertEqual(self.get(db, 'token_id'), (DOC, False))
+
+    def test_get_missing(self):
+        self.assertEqual(self.get(FakeDatabase(), 'token_id'), (None, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
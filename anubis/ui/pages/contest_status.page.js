@@ -2,14 +2,78 @@
  * Created by Nitori on 2017/4/21.
  */
 import { NamedPage } from '../misc/PageLoader';
+import i18n from '../utils/i18n';
+import tpl from '../utils/tpl';
+
+const PRIZE_CLASSES = ['back-gold', 'back-silver', 'back-bronze'];
+
+function renderProblemCell(pdetail) {
+    if (pdetail.accept) {
+        const naccept = pdetail.naccept ? ` (-${pdetail.naccept})` : '';
+        return tpl`<a href="${Context.record_prefix}/${pdetail.rid}" data-tooltip="${Math.floor(pdetail.time)}s">${i18n('Accepted')}</a>${naccept}`;
+    } else if (pdetail.naccept) {
+        return tpl`(-${pdetail.naccept})`;
+    }
+    return '-';
+}
+
+// Returns false if the row can not be moved on the page and the page needs reloading.
+function moveRow($tbody, delta) {
+    const begin = Context.page_begin;
+    const end = Context.page_end;
+    const indices = [delta.old_index, delta.index];
+    if (indices.every(index => index === null || index >= end)
+        || indices.every(index => index !== null && index < begin)) {
+        // Rows of this page are not moved.
+        return true;
+    }
+    if (!indices.every(index => index !== null && index >= begin && index < end)) {
+        return false;
+    }
+    const $row = $tbody.children(`tr[data-uid="${delta.uid}"]`);
+    if ($row.length === 0) {
+        return false;
+    }
+    $row.detach();
+    const $rows = $tbody.children();
+    if (delta.index - begin < $rows.length) {
+        $row.insertBefore($rows.eq(delta.index - begin));
+    } else {
+        $tbody.append($row);
+    }
+    $row.find('.col--solve').text(delta.accept);
+    $row.find('.col--time').text(delta.time);
+    delta.detail.forEach(pdetail => {
+        $row.find(`td[data-pid="${pdetail.pid}"]`).html(renderProblemCell(pdetail));
+    });
+    return true;
+}
+
+// Returns false if the page can not be patched by the delta and needs reloading.
+function applyDelta($tbody, delta) {
+    if (!moveRow($tbody, delta)) {
+        return false;
+    }
+    // Ranks of the rows of this page can change even if the moved row is on another page.
+    delta.ranks.forEach(([uid, rank, prize]) => {
+        const $rank = $tbody.children(`tr[data-uid="${uid}"]`).find('.col--rank');
+        $rank.removeClass(PRIZE_CLASSES.join(' '));
+        if (prize) {
+            $rank.addClass(`back-${prize}`);
+        }
+        $rank.text(rank);
+    });
+    return true;
+}
 
 const page = new NamedPage('contest_status', async () => {
     const SockJs = await System.import('sockjs-client');
     const sock = new SockJs(`/contest/${Context.tid}/notification-conn`);
+    const $tbody = $('.data-table tbody');
 
     sock.onmessage = message => {
         const msg = JSON.parse(message.data);
-        if (msg.type === 'rank_changed') {
+        if (msg.type === 'rank_changed' && !applyDelta($tbody, msg)) {
             window.location.reload();
         }
     };
@@ -0,0 +1,169 @@
+"""Request-scoped identity map of documents.
+
+A map is attached to the task handling a request by begin() until end(), and is inherited by the tasks
+created from it (e.g. by asyncio.gather) through task_factory(). Model getters consult the
+current map with get(), and model writers drop the namespace they change with discard().
+Outside of a request there is no map and every get() reads the database. Every get() returns
+its own copy of the document, which the caller may modify.
+
+BatchLoader merges the loads of documents by id made in the same tick of a request into one
+query, and keeps the loaded documents in the identity map.
+"""
+import asyncio
+import copy
+
+from anubis.util import options
+
+options.define('batch_loader_max_keys', default=1000, help='Maximum number of keys loaded in one query.')
+options.define('batch_loader_concurrency', default=4,
+               help='Maximum number of concurrent queries of a batch loader.')
+
+_ATTR = '_anubis_identity_map'
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError:
+    _current_task = asyncio.Task.current_task
+
+
+class IdentityMap(object):
+    def __init__(self):
+        self.futures = {}  # (namespace, key) -> future of document
+        self.batches = {}  # (namespace, group) -> dict of id -> future of document, not loaded yet
+        self.reads = 0
+        self.hits = 0
+
+
+def task_factory(loop, coro, **kwargs):
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    parent = _current_task(loop=loop)
+    identity_map = getattr(parent, _ATTR, None)
+    if identity_map:
+        setattr(task, _ATTR, identity_map)
+    return task
+
+
+def begin():
+    """Attach a new identity map to the current task and return it."""
+    identity_map = IdentityMap()
+    setattr(_current_task(), _ATTR, identity_map)
+    return identity_map
+
+
+def end():
+    """Detach the identity map from the current task and return it."""
+    task = _current_task()
+    identity_map = getattr(task, _ATTR, None)
+    if identity_map:
+        setattr(task, _ATTR, None)
+    return identity_map
+
+
+def current():
+    task = _current_task()
+    return getattr(task, _ATTR, None) if task else None
+
+
+async def get(namespace, key, load):
+    """Get a document through the current identity map, loading it by load() on a miss.
+
+    Concurrent gets of the same document share one read.
+    """
+    identity_map = current()
+    if not identity_map:
+        return await load()
+    future = identity_map.futures.get((namespace, key))
+    if future:
+        identity_map.hits += 1
+        return copy.deepcopy(await asyncio.shield(future))
+    identity_map.reads += 1
+    identity_map.futures[(namespace, key)] = future = asyncio.ensure_future(load())
+    try:
+        return copy.deepcopy(await asyncio.shield(future))
+    except Exception:
+        if identity_map.futures.get((namespace, key)) is future:
+            del identity_map.futures[(namespace, key)]
+        raise
+
+
+def discard(namespace):
+    """Drop the documents of a namespace from the current identity map after a write."""
+    identity_map = current()
+    if identity_map:
+        for map_key in [map_key for map_key in identity_map.futures if map_key[0] == namespace]:
+            del identity_map.futures[map_key]
+
+
+class BatchLoader(object):
+    """Loads documents of a namespace by id through the current identity map.
+
+    Ids missed in the same tick are loaded together by load_dict(ids, *args), which returns a dict
+    of id -> document, e.g. by a $in query. Loads with different args, e.g. projections, are never
+    merged. Each query has at most batch_loader_max_keys ids, and at most batch_loader_concurrency
+    queries of a loader run at the same time. Outside of a request ids are loaded directly.
+    """
+
+    def __init__(self, namespace, load_dict):
+        self.namespace = namespace
+        self.load_dict = load_dict
+        self._semaphore = None
+
+    async def load(self, id, *args):
+        """Get a document by id, or None if not found."""
+        return (await self.load_many([id], *args)).get(id)
+
+    async def load_many(self, ids, *args):
+        """Get a dict of id -> copy of the document of the ids found."""
+        identity_map = current()
+        if not identity_map:
+            return await self._load_dict(list(set(ids)), *args)
+        group = repr(args)
+        futures = {}
+        for id in ids:
+            if id in futures:
+                continue
+            future = identity_map.futures.get((self.namespace, (id, group)))
+            if future:
+                identity_map.hits += 1
+            else:
+                identity_map.reads += 1
+                future = asyncio.get_event_loop().create_future()
+                identity_map.futures[(self.namespace, (id, group))] = future
+                batch = identity_map.batches.get((self.namespace, group))
+                if batch is None:
+                    batch = identity_map.batches[(self.namespace, group)] = {}
+                    asyncio.get_event_loop().call_soon(self._flush, identity_map, group, args)
+                batch[id] = future
+            futures[id] = future
+        result = dict()
+        for id, future in futures.items():
+            doc = await asyncio.shield(future)
+            if doc is not None:
+                result[id] = copy.deepcopy(doc)
+        return result
+
+    def _flush(self, identity_map, group, args):
+        batch = list(identity_map.batches.pop((self.namespace, group)).items())
+        max_keys = options.options.batch_loader_max_keys
+        for i in range(0, len(batch), max_keys):
+            asyncio.ensure_future(self._load_batch(identity_map, group, args, batch[i:i + max_keys]))
+
+    async def _load_batch(self, identity_map, group, args, batch):
+        try:
+            docs = await self._load_dict([id for id, _ in batch], *args)
+        except Exception as e:
+            for id, future in batch:
+                if identity_map.futures.get((self.namespace, (id, group))) is future:
+                    del identity_map.futures[(self.namespace, (id, group))]
+                future.set_exception(e)
+            return
+        for id, future in batch:
+            future.set_result(docs.get(id))
+
+    async def _load_dict(self, ids, *args):
+        if not ids:
+            return dict()
+        if not self._semaphore:
+            self._semaphore = asyncio.Semaphore(options.options.batch_loader_concurrency)
+        async with self._semaphore:
+            return await self.load_dict(ids, *args)
@@ -0,0 +1,65 @@
+import collections
+import sys
+
+
+def sizeof(obj):
+    """Approximate size of an object and the objects it contains, in bytes."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k) + sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(v) for v in obj)
+    return size
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by the approximate size of values in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # key -> (value, size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = sizeof(value)
+        self.unset(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def unset(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -1,13 +1,84 @@
 import asyncio
+import base64
+import binascii
+
+import bson
+
 from anubis import error
 
 
-async def paginate(cursor, page: int, page_size: int):
+async def paginate(cursor, page: int, page_size: int, *, get_count=None):
+    """Paginate by skipping.
+
+    get_count is a coroutine function getting the number of documents, e.g. a cached count.
+    If not specified the cursor is counted.
+    """
     if page <= 0:
         raise error.ValidationError('page')
     count, page_docs = await asyncio.gather(
-        cursor.count(),
+        get_count() if get_count else cursor.count(),
         cursor.skip((page - 1) * page_size).limit(page_size).to_list(None)
     )
     num_pages = (count + page_size - 1) // page_size
     return page_docs, num_pages, count
+
+
+def _encode_token(values):
+    return base64.urlsafe_b64encode(bson.BSON.encode({'v': values})).decode().rstrip('=')
+
+
+def _decode_token(token):
+    try:
+        return bson.BSON(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))).decode()['v']
+    except (binascii.Error, bson.errors.BSONError, KeyError, ValueError):
+        raise error.ValidationError('after') from None
+
+
+def keyset_filter(sort, after):
+    """Get the filter of documents after a continuation token in the sort order."""
+    values = _decode_token(after)
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise error.ValidationError('after')
+    clauses = []
+    for index, (field, direction) in enumerate(sort):
+        clause = dict((sort_field, value) for (sort_field, _), value in zip(sort[:index], values))
+        clause[field] = {'$gt' if direction > 0 else '$lt': values[index]}
+        clauses.append(clause)
+    return {'$or': clauses}
+
+
+async def paginate_keyset(get_cursor, sort, page: int, page_size: int, after: str=None, *,
+                          get_count=None):
+    """Paginate by the sort key.
+
+    With a continuation token the page is read from the index right after the last document
+    of the previous page, instead of skipping all documents before it.
+
+    Args:
+        get_cursor: function returning the cursor of all documents, with extra filter as kwargs.
+        sort: list of (field, direction) ending with a unique field, e.g. _id.
+        page: page number, which is only used for skipping when there is no token.
+        page_size: number of documents per page.
+        after: continuation token of the previous page.
+        get_count: coroutine function getting the number of documents, e.g. a cached count.
+            If not specified the documents are counted.
+
+    Returns:
+        Tuple of (documents, number of pages, number of documents, token of the next page).
+    """
+    if page <= 0:
+        raise error.ValidationError('page')
+    if after:
+        cursor = get_cursor(**keyset_filter(sort, after))
+    else:
+        cursor = get_cursor().skip((page - 1) * page_size)
+    count, page_docs = await asyncio.gather(
+        get_count() if get_count else get_cursor().count(),
+        cursor.sort(sort).limit(page_size).to_list(None)
+    )
+    num_pages = (count + page_size - 1) // page_size
+    if page_docs and page < num_pages:
+        next_after = _encode_token([page_docs[-1][field] for field, _ in sort])
+    else:
+        next_after = None
+    return page_docs, num_pages, count, next_after
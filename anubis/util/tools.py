@@ -2,6 +2,8 @@ import logging
 import pkgutil
 from os import path
 
+import bson
+
 from anubis.util import argmethod
 
 _logger = logging.getLogger(__name__)
@@ -18,5 +20,37 @@ async def create_all_indexes():
                 await module.create_indexes()
 
 
+async def _measure_bytes(cursor):
+    return sum([len(bson.BSON.encode(doc)) async for doc in cursor])
+
+
+@argmethod.wrap
+async def benchmark_projections(domain_id: str, page_size: int=50):
+    """Measure the bytes of documents read from MongoDB for a page of each list, without and
+    with the list projection profiles."""
+    from anubis.model import problem
+    from anubis.model import record
+    from anubis.model import user
+
+    rdocs = await record.get_all_multi(domain_id=domain_id, projection={'uid': 1}).sort(
+        [('_id', -1)]).limit(page_size).to_list(None)
+    uids = list(set(rdoc['uid'] for rdoc in rdocs))
+    pages = {
+        'problem': (lambda projection: problem.get_multi(domain_id=domain_id, projection=projection)
+                    .sort([('_id', 1)]).limit(page_size),
+                    problem.PROJECTION_ALL, problem.PROJECTION_LIST),
+        'record': (lambda projection: record.get_all_multi(domain_id=domain_id, projection=projection)
+                   .sort([('_id', -1)]).limit(page_size),
+                   record.PROJECTION_ALL, record.PROJECTION_LIST),
+        'user': (lambda projection: user.get_multi(_id={'$in': uids}, fields=projection),
+                 user.PROJECTION_VIEW, user.PROJECTION_LIST),
+    }
+    result = {}
+    for name, (get_cursor, before, after) in pages.items():
+        result[name] = {'before': await _measure_bytes(get_cursor(before)),
+                        'after': await _measure_bytes(get_cursor(after))}
+    return result
+
+
 if __name__ == '__main__':
     argmethod.invoke_by_args()
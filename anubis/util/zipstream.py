@@ -0,0 +1,60 @@
+"""ZIP archives written to a stream as they are built.
+
+Entries are compressed off the event loop and the compressed bytes are written to the stream
+right after each entry, so only one entry is held in memory at a time.
+"""
+import asyncio
+import functools
+import time
+import zipfile
+
+
+class _Buffer(object):
+    """Unseekable file object collecting the bytes written by ZipFile until they are taken."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+class ZipStream(object):
+    def __init__(self, write, run=None):
+        """Create a ZIP stream.
+
+        Args:
+            write: coroutine function writing a chunk of bytes, e.g. StreamResponse.write.
+            run: coroutine function running func(*args) off the event loop, e.g. executor.run of
+                a task type. The default executor of the loop is used if None.
+        """
+        self._write = write
+        self._run_func = run or functools.partial(asyncio.get_event_loop().run_in_executor, None)
+        self._buffer = _Buffer()
+        self._zip_file = zipfile.ZipFile(self._buffer, 'w', zipfile.ZIP_DEFLATED)
+
+    async def _run(self, func, *args):
+        await self._run_func(func, *args)
+        data = self._buffer.take()
+        if data:
+            await self._write(data)
+
+    async def writestr(self, name, data):
+        zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.external_attr = 0o600 << 16
+        zinfo.create_system = 0
+        await self._run(self._zip_file.writestr, zinfo, data)
+
+    async def close(self):
+        """Write the central directory. The stream itself is not closed."""
+        await self._run(self._zip_file.close)